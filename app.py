@@ -2,19 +2,34 @@ import os
 import re
 import json
 import time
+import gzip
 import base64
+import fcntl
+import hashlib
 import shutil
+import random
 import asyncio
+import psutil
 import requests
 import platform
 import subprocess
+import signal
+import socket
+import ssl
+import shlex
 import threading
 from threading import Thread
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, parse_qs, quote
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Environment variables
 UPLOAD_URL = os.environ.get('UPLOAD_URL', '')
-PROJECT_URL = os.environ.get('PROJECT_URL', '')        ,
+PROJECT_URL = os.environ.get('PROJECT_URL', '')        
 AUTO_ACCESS = os.environ.get('AUTO_ACCESS', 'false').lower() == 'true'  
 FILE_PATH = os.environ.get('FILE_PATH', './.cache')   
 SUB_PATH = os.environ.get('SUB_PATH', 'sub')           
@@ -31,6 +46,43 @@ NAME = os.environ.get('NAME', 'streamlit')
 CHAT_ID = os.environ.get('CHAT_ID', '')                
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '')           
 PORT = int(os.environ.get('SERVER_PORT') or os.environ.get('PORT') or 3000) # 订阅端口，如无法订阅，请手动修改为分配的端口
+SERVER_MAX_CONNECTIONS = int(os.environ.get('SERVER_MAX_CONNECTIONS', '256'))  # 订阅服务最大并发连接数，每个连接一个线程
+SERVER_BACKLOG = int(os.environ.get('SERVER_BACKLOG', '128'))         # 订阅服务监听队列长度
+KEEPALIVE_TIMEOUT = int(os.environ.get('KEEPALIVE_TIMEOUT', '15'))    # 空闲长连接超时秒数
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', '65536'))  # 下载分块大小(字节)
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', '3'))       # 下载失败重试次数
+DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', '30'))      # 下载连接/读取超时秒数
+DOWNLOAD_MANIFEST = os.environ.get('DOWNLOAD_MANIFEST', '')           # SHA-256 校验清单，JSON 文件路径或 JSON 字符串
+ARTIFACT_CACHE_DIR = os.environ.get('ARTIFACT_CACHE_DIR', '')         # 二进制缓存目录，默认 FILE_PATH/artifacts
+ARTIFACT_CACHE_MAX_MB = int(os.environ.get('ARTIFACT_CACHE_MAX_MB', '512'))  # 二进制缓存容量上限(MB)
+ARGO_DISCOVERY_TIMEOUT = int(os.environ.get('ARGO_DISCOVERY_TIMEOUT', '30'))  # 等待临时隧道域名的超时秒数
+ARGO_DISCOVERY_RETRIES = int(os.environ.get('ARGO_DISCOVERY_RETRIES', '3'))   # 未获取到域名时重启隧道的次数
+READY_TIMEOUT = int(os.environ.get('READY_TIMEOUT', '15'))            # 等待子进程就绪的超时秒数
+RESTART_BACKOFF_MAX = int(os.environ.get('RESTART_BACKOFF_MAX', '60'))  # 子进程重启退避上限秒数
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE', 'false').lower() == 'true'  # 记录启动各阶段耗时并输出时间线
+HTTP_TIMEOUT = int(os.environ.get('HTTP_TIMEOUT', '10'))              # 上报/推送请求超时秒数
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3'))               # 上报/推送请求重试次数
+ISP_NAME = os.environ.get('ISP_NAME', '')                             # 节点名称中的 ISP，留空则自动获取
+ISP_CACHE_TTL = int(os.environ.get('ISP_CACHE_TTL', '86400'))         # ISP 查询结果缓存秒数
+CFIP_LIST = os.environ.get('CFIP_LIST', '')                           # 候选优选域名/IP，逗号分隔，可写 host:port
+CFPORT_LIST = os.environ.get('CFPORT_LIST', '')                       # 候选端口，逗号分隔，用于未写端口的候选
+CFIP_TOP = int(os.environ.get('CFIP_TOP', '0'))                       # 订阅中保留延迟最低的前 N 个，0 为全部
+CFIP_PROBE_INTERVAL = int(os.environ.get('CFIP_PROBE_INTERVAL', '1800'))  # 重新测速间隔秒数，0 为不重测
+ARGO_TUNNELS = max(1, int(os.environ.get('ARGO_TUNNELS', '1')))       # 隧道连接器数量，临时隧道每个连接器一个域名
+ARGO_PROTOCOL = os.environ.get('ARGO_PROTOCOL', 'http2')              # 隧道传输协议：http2、quic 或 auto
+STATUS_SOCKET = os.environ.get('STATUS_SOCKET', '/tmp/app-status.sock')  # 本地状态推送 Unix socket，留空则关闭
+ENV_FILE = os.environ.get('ENV_FILE', './env.sh')                     # SIGHUP 或 reload 命令时重新读取的环境文件
+KEEP_CHILDREN = os.environ.get('KEEP_CHILDREN', 'true').lower() == 'true'  # 退出时保留子进程，下次启动时校验后接管
+XRAY_PROTOCOLS = os.environ.get('XRAY_PROTOCOLS', 'vless,vmess,trojan')  # 启用的协议，逗号分隔：vless,vmess,trojan
+XRAY_PORT_BASE = int(os.environ.get('XRAY_PORT_BASE', '3001'))        # 本地回落端口起始值，依次分配给各协议
+XRAY_SNIFFING = os.environ.get('XRAY_SNIFFING', 'true').lower() == 'true'  # 是否开启流量嗅探
+XRAY_SNIFF_DEST = os.environ.get('XRAY_SNIFF_DEST', 'http,tls,quic')  # 嗅探类型，逗号分隔
+XRAY_SNIFF_METADATA_ONLY = os.environ.get('XRAY_SNIFF_METADATA_ONLY', 'false').lower() == 'true'  # 仅用元数据嗅探，不读取流量内容
+XRAY_BUFFER_SIZE = int(os.environ.get('XRAY_BUFFER_SIZE', '-1'))      # 每连接缓冲区大小(KB)，-1 为 xray 默认
+XRAY_LOGLEVEL = os.environ.get('XRAY_LOGLEVEL', 'none')               # xray 日志级别
+# 子进程资源限制，前缀 WEB_ / BOT_ / NEZHA_ 分别对应 xray、隧道、哪吒探针:
+#   *_CPU_AFFINITY 绑定的 CPU，如 0-1,3    *_NICE 调度优先级 -20~19
+#   *_IONICE IO 优先级，如 idle、be:7、rt:0   *_NOFILE 最大文件描述符数   *_MEMORY_MB 虚拟内存上限(MB)
 
 # Create running folder
 def create_directory():
@@ -50,6 +102,17 @@ sub_path = os.path.join(FILE_PATH, 'sub.txt')
 list_path = os.path.join(FILE_PATH, 'list.txt')
 boot_log_path = os.path.join(FILE_PATH, 'boot.log')
 config_path = os.path.join(FILE_PATH, 'config.json')
+isp_cache_path = os.path.join(FILE_PATH, 'isp.json')
+links_state_path = os.path.join(FILE_PATH, 'links.json')
+nodes_path = os.path.join(FILE_PATH, 'nodes.json')
+state_path = os.path.join(FILE_PATH, 'state.json')
+
+# Write a file through a temp file and rename, so readers never see it half-written
+def write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data.encode('utf-8') if isinstance(data, str) else data)
+    os.replace(tmp_path, path)
 
 # Delete nodes
 def delete_nodes():
@@ -72,12 +135,7 @@ def delete_nodes():
         if not nodes:
             return
 
-        try:
-            requests.post(f"{UPLOAD_URL}/api/delete-nodes", 
-                          data=json.dumps({"nodes": nodes}),
-                          headers={"Content-Type": "application/json"})
-        except:
-            return None
+        outbound.submit_batch(f"{UPLOAD_URL}/api/delete-nodes", "nodes", nodes, label='delete nodes')
     except Exception as e:
         print(f"Error in delete_nodes: {e}")
         return None
@@ -85,6 +143,9 @@ def delete_nodes():
 # Clean up old files
 def cleanup_old_files():
     paths_to_delete = ['web', 'bot', 'npm', 'php', 'boot.log', 'list.txt']
+    # Logs of extra tunnel connectors, however many the previous run had
+    if os.path.isdir(FILE_PATH):
+        paths_to_delete += [name for name in os.listdir(FILE_PATH) if re.fullmatch(r'boot-\d+\.log', name)]
     for file in paths_to_delete:
         file_path = os.path.join(FILE_PATH, file)
         try:
@@ -96,31 +157,505 @@ def cleanup_old_files():
         except Exception as e:
             print(f"Error removing {file_path}: {e}")
 
+# Opt-in timeline of startup phases, downloads, spawns, waits and outbound HTTP calls
+class StartupProfiler:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.wall_origin = time.time()
+        self.spans = []
+        self.marks = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self.origin
+
+    @contextmanager
+    def span(self, name, category, **attrs):
+        if not self.enabled:
+            yield
+            return
+        started = self.now()
+        try:
+            yield
+        finally:
+            record = {
+                "name": name,
+                "category": category,
+                "start": round(started, 4),
+                "duration": round(self.now() - started, 4),
+                "thread": threading.current_thread().name,
+            }
+            record.update(attrs)
+            with self.lock:
+                self.spans.append(record)
+
+    def mark(self, name):
+        if self.enabled:
+            with self.lock:
+                self.marks.setdefault(name, round(self.now(), 4))
+
+    def report(self, path):
+        if not self.enabled:
+            return
+        with self.lock:
+            spans = sorted(self.spans, key=lambda record: record["start"])
+            marks = dict(self.marks)
+        timeline = {
+            "started_at": self.wall_origin,
+            "total": round(self.now(), 4),
+            "marks": marks,
+            "spans": spans,
+        }
+        try:
+            with open(path, 'w') as f:
+                json.dump(timeline, f, indent=2)
+        except OSError as e:
+            print(f"Failed to write startup profile: {e}")
+
+        totals = {}
+        for record in spans:
+            totals[record["category"]] = totals.get(record["category"], 0) + record["duration"]
+
+        print(f"\nStartup profile ({path})")
+        for record in spans:
+            print(f"  {record['start']:8.3f}s  +{record['duration']:7.3f}s  {record['category']:<8} {record['name']}")
+        for name, offset in sorted(marks.items(), key=lambda item: item[1]):
+            print(f"  {offset:8.3f}s  {name}")
+        print("  busy time by category: " + ", ".join(f"{category} {seconds:.2f}s" for category, seconds in sorted(totals.items())))
+        print(f"  total {timeline['total']:.3f}s, time to first subscription {marks.get('first_subscription', 'n/a')}s")
+
+profiler = StartupProfiler(STARTUP_PROFILE)
+
+def traced(name, category, func, *args):
+    with profiler.span(name, category):
+        return func(*args)
+
+# Request, cache, child process and startup counters in Prometheus text format
+class Metrics:
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.bytes_sent = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.stages = {}
+
+    def observe_request(self, route, status, seconds, nbytes):
+        with self.lock:
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_sent[route] = self.bytes_sent.get(route, 0) + nbytes
+            histogram = self.latency.setdefault(route, {"buckets": [0] * len(self.LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def record_cache(self, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = seconds
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self.lock:
+            metric('app_http_requests_total', 'counter', 'HTTP requests by route and status.',
+                   [({"route": route, "status": status}, count) for (route, status), count in sorted(self.requests.items())])
+
+            histogram_samples = []
+            for route, histogram in sorted(self.latency.items()):
+                for bound, count in zip(self.LATENCY_BUCKETS, histogram["buckets"]):
+                    histogram_samples.append(({"route": route, "le": bound}, count))
+                histogram_samples.append(({"route": route, "le": "+Inf"}, histogram["count"]))
+            lines.append("# HELP app_http_request_duration_seconds HTTP request latency by route.")
+            lines.append("# TYPE app_http_request_duration_seconds histogram")
+            for labels, value in histogram_samples:
+                lines.append(f'app_http_request_duration_seconds_bucket{{route="{labels["route"]}",le="{labels["le"]}"}} {value}')
+            for route, histogram in sorted(self.latency.items()):
+                lines.append(f'app_http_request_duration_seconds_sum{{route="{route}"}} {histogram["sum"]:.6f}')
+                lines.append(f'app_http_request_duration_seconds_count{{route="{route}"}} {histogram["count"]}')
+
+            metric('app_http_response_bytes_total', 'counter', 'Response body bytes sent by route.',
+                   [({"route": route}, count) for route, count in sorted(self.bytes_sent.items())])
+
+            lookups = self.cache_hits + self.cache_misses
+            metric('app_subscription_cache_hits_total', 'counter', 'Subscription requests served from memory.', [({}, self.cache_hits)])
+            metric('app_subscription_cache_misses_total', 'counter', 'Subscription requests that reloaded sub.txt.', [({}, self.cache_misses)])
+            metric('app_subscription_cache_hit_ratio', 'gauge', 'Share of subscription requests served from memory.',
+                   [({}, f"{self.cache_hits / lookups:.4f}" if lookups else 0)])
+
+            metric('app_startup_stage_duration_seconds', 'gauge', 'Duration of the last run of each startup stage.',
+                   [({"stage": stage}, f"{seconds:.3f}") for stage, seconds in self.stages.items()])
+
+        up, cpu, rss, uptime, restarts = [], [], [], [], []
+        for name, status in supervisor.status().items():
+            labels = {"process": name}
+            up.append((labels, int(status["alive"])))
+            uptime.append((labels, status["uptime"]))
+            restarts.append((labels, status["restarts"]))
+            if not status["alive"]:
+                continue
+            try:
+                process = psutil.Process(status["pid"])
+                cpu_times = process.cpu_times()
+                cpu.append((labels, f"{cpu_times.user + cpu_times.system:.2f}"))
+                rss.append((labels, process.memory_info().rss))
+            except psutil.Error:
+                pass
+        metric('app_child_up', 'gauge', 'Whether the supervised process is running.', up)
+        metric('app_child_uptime_seconds', 'gauge', 'Seconds since the supervised process was started.', uptime)
+        metric('app_child_restarts_total', 'counter', 'Restarts performed by the supervisor.', restarts)
+        metric('app_child_cpu_seconds_total', 'counter', 'User and system CPU time of the supervised process.', cpu)
+        metric('app_child_resident_memory_bytes', 'gauge', 'Resident set size of the supervised process.', rss)
+
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Time a startup stage and record its duration
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    status_board.update(stage=name)
+    try:
+        with profiler.span(name, 'stage'):
+            yield
+    finally:
+        metrics.record_stage(name, time.perf_counter() - started)
+
+async def timed(name, awaitable):
+    with stage(name):
+        return await awaitable
+
+# Node share link as understood by v2rayN-style clients
+def node_uri(node):
+    path = quote(f"{node['path']}?ed=2560", safe='')
+    # IPv6 literals need brackets in URI authorities, the vmess JSON "add" field takes them bare
+    server = f"[{node['server']}]" if ':' in node["server"] else node["server"]
+    if node["type"] == 'vmess':
+        vmess = {"v": "2", "ps": node["name"], "add": node["server"], "port": node["port"], "id": node["uuid"], "aid": "0", "scy": "none", "net": "ws", "type": "none", "host": node["host"], "path": f"{node['path']}?ed=2560", "tls": "tls", "sni": node["sni"], "alpn": "", "fp": node["fp"]}
+        return f"vmess://{base64.b64encode(json.dumps(vmess).encode('utf-8')).decode('utf-8')}"
+    if node["type"] == 'vless':
+        return f"vless://{node['uuid']}@{server}:{node['port']}?encryption=none&security=tls&sni={node['sni']}&fp={node['fp']}&type=ws&host={node['host']}&path={path}#{node['name']}"
+    return f"trojan://{node['uuid']}@{server}:{node['port']}?security=tls&sni={node['sni']}&fp={node['fp']}&type=ws&host={node['host']}&path={path}#{node['name']}"
+
+# Clash and sing-box need unique proxy names, share links keep the plain label
+def node_tag(node):
+    return f"{node['name']}-{node['type']}"
+
+def render_raw(nodes):
+    return ''.join(node_uri(node) + '\n' for node in nodes)
+
+def render_base64(nodes):
+    return base64.b64encode(render_raw(nodes).encode('utf-8')).decode('utf-8')
+
+# Clash / mihomo profile, JSON strings double as YAML quoted scalars.
+# Only mihomo (Clash.Meta) cores and Stash understand vless, plain Clash rejects the whole profile.
+def render_clash(nodes, vless=False):
+    nodes = [node for node in nodes if vless or node["type"] != 'vless']
+    lines = ['proxies:']
+    for node in nodes:
+        lines += [
+            f'  - name: {json.dumps(node_tag(node))}',
+            f'    type: {node["type"]}',
+            f'    server: {json.dumps(node["server"])}',
+            f'    port: {node["port"]}',
+        ]
+        if node["type"] == 'trojan':
+            lines += [f'    password: {json.dumps(node["uuid"])}', f'    sni: {json.dumps(node["sni"])}']
+        else:
+            lines += [f'    uuid: {json.dumps(node["uuid"])}', f'    servername: {json.dumps(node["sni"])}']
+            if node["type"] == 'vmess':
+                lines += ['    alterId: 0', '    cipher: none']
+        lines += [
+            '    tls: true',
+            '    udp: true',
+            f'    client-fingerprint: {node["fp"]}',
+            '    network: ws',
+            '    ws-opts:',
+            f'      path: {json.dumps(node["path"])}',
+            '      headers:',
+            f'        Host: {json.dumps(node["host"])}',
+            '      max-early-data: 2560',
+            '      early-data-header-name: Sec-WebSocket-Protocol',
+        ]
+    names = [json.dumps(node_tag(node)) for node in nodes]
+    lines += [
+        'proxy-groups:',
+        '  - name: PROXY',
+        '    type: select',
+        f'    proxies: [AUTO, {", ".join(names)}]',
+        '  - name: AUTO',
+        '    type: url-test',
+        '    url: http://www.gstatic.com/generate_204',
+        '    interval: 300',
+        f'    proxies: [{", ".join(names)}]',
+        'rules:',
+        '  - MATCH,PROXY',
+    ]
+    return '\n'.join(lines) + '\n'
+
+def render_mihomo(nodes):
+    return render_clash(nodes, vless=True)
+
+def render_singbox(nodes):
+    outbounds = []
+    for node in nodes:
+        outbound = {
+            "type": node["type"],
+            "tag": node_tag(node),
+            "server": node["server"],
+            "server_port": node["port"],
+            "tls": {"enabled": True, "server_name": node["sni"], "utls": {"enabled": True, "fingerprint": node["fp"]}},
+            "transport": {"type": "ws", "path": node["path"], "headers": {"Host": node["host"]},
+                          "max_early_data": 2560, "early_data_header_name": "Sec-WebSocket-Protocol"},
+        }
+        if node["type"] == 'trojan':
+            outbound["password"] = node["uuid"]
+        else:
+            outbound["uuid"] = node["uuid"]
+        if node["type"] == 'vmess':
+            outbound.update({"security": "none", "alter_id": 0})
+        outbounds.append(outbound)
+    tags = [node_tag(node) for node in nodes]
+    outbounds += [
+        {"type": "selector", "tag": "proxy", "outbounds": ["auto", *tags]},
+        {"type": "urltest", "tag": "auto", "outbounds": tags},
+        {"type": "direct", "tag": "direct"},
+    ]
+    return json.dumps({"outbounds": outbounds, "route": {"final": "proxy"}}, ensure_ascii=False, indent=2)
+
+SUBSCRIPTION_FORMATS = {
+    'base64': ('text/plain; charset=utf-8', render_base64),
+    'raw': ('text/plain; charset=utf-8', render_raw),
+    'clash': ('text/yaml; charset=utf-8', render_clash),
+    'mihomo': ('text/yaml; charset=utf-8', render_mihomo),
+    'singbox': ('application/json; charset=utf-8', render_singbox),
+}
+FORMAT_ALIASES = {'v2ray': 'base64', 'list': 'raw', 'meta': 'mihomo', 'clash-meta': 'mihomo', 'stash': 'mihomo', 'sing-box': 'singbox'}
+
+# Pick a format from ?format= / ?target=, then from the client's User-Agent
+def negotiate_format(query, user_agent):
+    params = parse_qs(query)
+    requested = (params.get('format') or params.get('target') or [''])[0].lower()
+    requested = FORMAT_ALIASES.get(requested, requested)
+    if requested in SUBSCRIPTION_FORMATS:
+        return requested
+
+    user_agent = user_agent.lower()
+    if any(name in user_agent for name in ('mihomo', 'meta', 'stash', 'verge', 'flclash')):
+        return 'mihomo'
+    if 'clash' in user_agent:
+        return 'clash'
+    if any(name in user_agent for name in ('sing-box', 'sfa', 'sfi', 'sfm')):
+        return 'singbox'
+    return 'base64'
+
+# Node model from nodes.json with every format rendered once, plus validators and gzip variant
+class SubscriptionCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.nodes = None
+        self.entries = {}
+        self.stamp = None
+
+    def invalidate(self):
+        with self.lock:
+            self.nodes = None
+            self.entries = {}
+            self.stamp = None
+
+    def get(self, fmt='base64'):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.invalidate()
+            return None
+
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            if self.stamp != stamp:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self.nodes = json.load(f)
+                except (OSError, ValueError):
+                    return None
+                self.entries = {}
+                self.stamp = stamp
+
+            entry = self.entries.get(fmt)
+            metrics.record_cache(entry is not None)
+            if entry is not None:
+                return entry
+
+            content_type, render = SUBSCRIPTION_FORMATS[fmt]
+            body = render(self.nodes).encode('utf-8')
+            digest = hashlib.sha256(body).hexdigest()[:32]
+            gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+            entry = {
+                "body": body,
+                "gzip": gzip_body if len(gzip_body) < len(body) else None,
+                "content_type": content_type,
+                "etag": f'"{digest}"',
+                "gzip_etag": f'"{digest}-gz"',
+                "mtime": int(st.st_mtime),
+                "last_modified": formatdate(st.st_mtime, usegmt=True),
+            }
+            self.entries[fmt] = entry
+            return entry
+
+sub_cache = SubscriptionCache(nodes_path)
+
 class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def send_body(self, status, body=b'', content_type='text/plain', headers=None):
+        sent = len(body) if self.command != 'HEAD' else 0
+        metrics.observe_request(self.route, status, time.perf_counter() - self.started, sent)
+        self.send_response(status)
+        if body:
+            self.send_header('Content-type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.server.saturated():
+            self.send_header('Connection', 'close')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def accepts_gzip(self):
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.strip().partition(';')
+            if name.strip().lower() in ('gzip', '*'):
+                return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
+
+    def is_not_modified(self, entry):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return entry["etag"] in tags or entry["gzip_etag"] in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return entry["mtime"] <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_subscription(self, query):
+        fmt = negotiate_format(query, self.headers.get('User-Agent', ''))
+        entry = sub_cache.get(fmt)
+        if entry is None:
+            self.send_body(404)
+            return
+
+        use_gzip = entry["gzip"] is not None and self.accepts_gzip()
+        headers = {
+            'ETag': entry["gzip_etag"] if use_gzip else entry["etag"],
+            'Last-Modified': entry["last_modified"],
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding, User-Agent',
+        }
+        if self.is_not_modified(entry):
+            self.send_body(304, headers=headers)
+            return
+
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            self.send_body(200, entry["gzip"], entry["content_type"], headers)
+        else:
+            self.send_body(200, entry["body"], entry["content_type"], headers)
+
     def do_GET(self):
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b'Hello World')
+        self.started = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path == '/':
+            self.route = 'root'
+            self.send_body(200, b'Hello World', 'text/html')
             
-        elif self.path == f'/{SUB_PATH}':
-            try:
-                with open(sub_path, 'rb') as f:
-                    content = f.read()
-                self.send_response(200)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(content)
-            except:
-                self.send_response(404)
-                self.end_headers()
+        elif url.path == f'/{SUB_PATH}':
+            self.route = 'sub'
+            self.send_subscription(url.query)
+        elif url.path == '/metrics':
+            self.route = 'metrics'
+            self.send_body(200, metrics.render().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
         else:
-            self.send_response(404)
-            self.end_headers()
+            self.route = 'other'
+            self.send_body(404)
+
+    do_HEAD = do_GET
 
     def log_message(self, format, *args):
         pass
+
+# Thread-pooled HTTP server, keeps connections alive and drains them on shutdown
+class SubscriptionServer(ThreadingHTTPServer):
+    allow_reuse_address = True
+    request_queue_size = SERVER_BACKLOG
+    # Each connection has its own thread, so an idle keep-alive client never holds up other subscribers
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, server_address, handler_class, max_connections=SERVER_MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self.max_connections = max_connections
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    # Refuse connections over the cap, the client sees a reset and retries
+    def verify_request(self, request, client_address):
+        with self.connections_lock:
+            if len(self.connections) >= self.max_connections:
+                return False
+            self.connections.add(request)
+        return True
+
+    # Near the cap, stop offering keep-alive so idle connections drain
+    def saturated(self):
+        with self.connections_lock:
+            return len(self.connections) >= self.max_connections * 3 // 4
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        super().shutdown_request(request)
+
+    def server_close(self):
+        # Wake up idle keep-alive connections so their threads finish before they are joined
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        super().server_close()
     
 # Determine system architecture
 def get_system_architecture():
@@ -130,24 +665,408 @@ def get_system_architecture():
     else:
         return 'amd'
 
-# Download file based on architecture
-def download_file(file_name, file_url):
-    file_path = os.path.join(FILE_PATH, file_name)
+# Shared HTTP session with a connection pool
+def create_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+download_session = create_session()
+
+class CircuitOpenError(Exception):
+    pass
+
+# Stop calling a host after repeated failures, probe it again after a cooldown
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        # Half-open: let a single probe through once the cooldown has passed
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    # The probe ended without telling us anything about the host
+    def release(self):
+        self.probing = False
+
+# Shared outbound HTTP client: pooled session, timeouts, jittered retries, per-host
+# circuit breakers and a background queue that merges repeated batch calls
+class OutboundClient:
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, coalesce_delay=1.0):
+        self.session = create_session()
+        self.timeout = timeout
+        self.retries = retries
+        self.coalesce_delay = coalesce_delay
+        self.breakers = {}
+        self.jobs = []
+        self.active = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def request(self, method, url, **kwargs):
+        parts = urlsplit(url)
+        with self.cond:
+            breaker = self.breakers.setdefault(parts.netloc, CircuitBreaker())
+            if not breaker.allow():
+                raise CircuitOpenError(f"circuit open for {parts.netloc}")
+
+        timeout = kwargs.pop('timeout', self.timeout)
+        retries = kwargs.pop('retries', self.retries)
+        error = None
+        for attempt in range(retries + 1):
+            try:
+                with profiler.span(f'{method} {parts.netloc}{parts.path}', 'http'):
+                    response = self.session.request(method, url, timeout=timeout, **kwargs)
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise requests.HTTPError(f"{response.status_code} from {parts.netloc}", response=response)
+                with self.cond:
+                    breaker.success()
+                return response
+            except requests.RequestException as e:
+                error = e
+                if attempt < retries:
+                    # Full jitter keeps retries from many instances apart
+                    time.sleep(random.uniform(0, min(2 ** attempt, 10)))
+            except BaseException:
+                with self.cond:
+                    breaker.release()
+                raise
+        with self.cond:
+            breaker.failure()
+        raise error
+
+    # Queue a call for the background worker
+    def submit(self, method, url, label, on_response=None, **kwargs):
+        self.enqueue({"method": method, "url": url, "kwargs": kwargs, "label": label,
+                      "on_response": on_response, "due": time.monotonic()})
+
+    # Queue a JSON {field: items} POST, merged into the newest queued call to the same url
+    def submit_batch(self, url, field, items, label, on_response=None):
+        with self.cond:
+            tail = self.jobs[-1] if self.jobs else None
+            if tail and tail["url"] == url and tail.get("field") == field:
+                tail["items"].extend(item for item in items if item not in tail["items"])
+                return
+        self.enqueue({"method": "POST", "url": url, "kwargs": {}, "label": label, "on_response": on_response,
+                      "field": field, "items": list(dict.fromkeys(items)), "due": time.monotonic() + self.coalesce_delay})
+
+    def enqueue(self, job):
+        with self.cond:
+            self.jobs.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='outbound', daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                job = self.jobs[0]
+                delay = job["due"] - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                self.jobs.pop(0)
+                self.active += 1
+            try:
+                self.execute(job)
+            finally:
+                with self.cond:
+                    self.active -= 1
+                    self.cond.notify_all()
+
+    def execute(self, job):
+        kwargs = dict(job["kwargs"])
+        if "field" in job:
+            kwargs["json"] = {job["field"]: job["items"]}
+        try:
+            response = self.request(job["method"], job["url"], **kwargs)
+            if job["on_response"]:
+                job["on_response"](response)
+        except Exception as e:
+            print(f"Failed to {job['label']}: {e}")
+
+    # Send whatever is still queued, used on shutdown
+    def flush(self, timeout=10):
+        with self.cond:
+            for job in self.jobs:
+                job["due"] = 0
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.jobs and not self.active, timeout)
+
+outbound = OutboundClient()
+
+# Load expected SHA-256 digests, keyed by file name or URL
+def load_download_manifest():
+    if not DOWNLOAD_MANIFEST:
+        return {}
     try:
-        response = requests.get(file_url, stream=True)
+        if os.path.exists(DOWNLOAD_MANIFEST):
+            with open(DOWNLOAD_MANIFEST, 'r') as f:
+                manifest = json.load(f)
+        else:
+            manifest = json.loads(DOWNLOAD_MANIFEST)
+        return {key: value.lower() for key, value in manifest.items()}
+    except Exception as e:
+        print(f"Error loading download manifest: {e}")
+        return {}
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Content-addressed store of downloaded binaries, survives cleanup_old_files()
+class ArtifactCache:
+    FICLONE = 0x40049409
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(file_url, architecture):
+        return hashlib.sha256(f"{architecture}|{file_url}".encode('utf-8')).hexdigest()[:32]
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        tmp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+    def blob_path(self, entry):
+        return os.path.join(self.blob_dir, entry["sha256"])
+
+    def lookup(self, file_url, architecture):
+        with self.lock:
+            entry = self.load_index().get(self.key(file_url, architecture))
+        if entry and os.path.exists(self.blob_path(entry)):
+            return entry
+        return None
+
+    # Move src_path into the cache, returns None and leaves src_path alone when it can never fit
+    def store(self, file_url, architecture, src_path, etag=None, last_modified=None):
+        if os.path.getsize(src_path) > self.max_bytes:
+            return None
+        os.makedirs(self.blob_dir, exist_ok=True)
+        digest = file_sha256(src_path)
+        entry = {
+            "url": file_url,
+            "arch": architecture,
+            "etag": etag,
+            "last_modified": last_modified,
+            "sha256": digest,
+            "size": os.path.getsize(src_path),
+            "last_used": time.time(),
+        }
+        if os.path.exists(self.blob_path(entry)):
+            os.remove(src_path)
+        else:
+            shutil.move(src_path, self.blob_path(entry))
+        with self.lock:
+            index = self.load_index()
+            key = self.key(file_url, architecture)
+            index[key] = entry
+            self.evict(index, keep=key)
+            self.save_index(index)
+        return entry
+
+    def touch(self, file_url, architecture):
+        with self.lock:
+            index = self.load_index()
+            entry = index.get(self.key(file_url, architecture))
+            if entry:
+                entry["last_used"] = time.time()
+                self.save_index(index)
+
+    # Drop least recently used entries until the cache fits, keeping blobs still referenced
+    # and never the entry that is being stored
+    def evict(self, index, keep=None):
+        total = sum(entry["size"] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del index[key]
+            total -= entry["size"]
+            if not any(other["sha256"] == entry["sha256"] for other in index.values()):
+                try:
+                    os.remove(self.blob_path(entry))
+                except OSError:
+                    pass
+
+    # Materialize a cached blob at dest_path: hardlink, then reflink, then plain copy
+    def link(self, entry, dest_path):
+        src_path = self.blob_path(entry)
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(src_path, dest_path)
+            return
+        except OSError:
+            pass
+        try:
+            with open(src_path, 'rb') as src, open(dest_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfile(src_path, dest_path)
+
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_DIR or os.path.join(FILE_PATH, 'artifacts'), ARTIFACT_CACHE_MAX_MB * 1024 * 1024)
+
+# Fetch url into part_path, resuming from whatever is already there
+def fetch_to_part(file_url, part_path, conditional_headers=None):
+    validator_path = part_path + '.etag'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # Without a validator the server cannot tell us the file changed, so start over
+    if offset and not os.path.exists(validator_path):
+        os.remove(part_path)
+        offset = 0
+    headers = dict(conditional_headers or {})
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        with open(validator_path, 'r') as f:
+            headers['If-Range'] = f.read().strip()
+
+    with download_session.get(file_url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:
+            return response.status_code, None, None
+        if response.status_code == 416:
+            os.remove(part_path)
+            raise IOError('stale partial download discarded')
         response.raise_for_status()
-        
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
+
+        resumed = response.status_code == 206 and response.headers.get('Content-Range', '').startswith(f'bytes {offset}-')
+        if response.status_code == 206 and not resumed:
+            # A range we did not ask for is not the whole file, retry from scratch
+            for path in (part_path, validator_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise IOError(f"unexpected Content-Range {response.headers.get('Content-Range')!r}, partial download discarded")
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        validator = etag or last_modified
+        if not resumed:
+            if validator:
+                with open(validator_path, 'w') as f:
+                    f.write(validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+
+        with open(part_path, 'ab' if resumed else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 f.write(chunk)
-        
-        print(f"Download {file_name} successfully")
+        return response.status_code, etag, last_modified
+
+# Download file based on architecture
+def download_file(file_name, file_url, expected_sha256=None, architecture=None):
+    file_path = os.path.join(FILE_PATH, file_name)
+    part_path = file_path + '.part'
+    architecture = architecture or get_system_architecture()
+
+    cached = artifact_cache.lookup(file_url, architecture)
+    if cached and expected_sha256 and cached["sha256"] != expected_sha256:
+        cached = None
+    conditional_headers = {}
+    if cached and cached.get("etag"):
+        conditional_headers['If-None-Match'] = cached["etag"]
+    elif cached and cached.get("last_modified"):
+        conditional_headers['If-Modified-Since'] = cached["last_modified"]
+
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            status, etag, last_modified = fetch_to_part(file_url, part_path, conditional_headers)
+
+            if status == 304 and cached:
+                artifact_cache.link(cached, file_path)
+                artifact_cache.touch(file_url, architecture)
+                print(f"{file_name} is up to date, using cached copy")
+                return True
+
+            if expected_sha256:
+                digest = file_sha256(part_path)
+                if digest != expected_sha256:
+                    os.remove(part_path)
+                    raise ValueError(f"checksum mismatch, expected {expected_sha256} got {digest}")
+
+            entry = artifact_cache.store(file_url, architecture, part_path, etag, last_modified)
+            if entry:
+                artifact_cache.link(entry, file_path)
+            else:
+                # Larger than ARTIFACT_CACHE_MAX_MB, use it without caching
+                os.replace(part_path, file_path)
+            if os.path.exists(part_path + '.etag'):
+                os.remove(part_path + '.etag')
+            print(f"Download {file_name} successfully")
+            return True
+        except Exception as e:
+            if attempt < DOWNLOAD_RETRIES:
+                delay = min(2 ** attempt, 30)
+                print(f"Download {file_name} failed: {e}, retrying in {delay}s")
+                with profiler.span(f'retry {file_name}', 'sleep', seconds=delay):
+                    time.sleep(delay)
+            else:
+                print(f"Download {file_name} failed: {e}")
+
+    # Upstream unreachable, fall back to the last good copy
+    if cached:
+        artifact_cache.link(cached, file_path)
+        artifact_cache.touch(file_url, architecture)
+        print(f"Using cached {file_name} from a previous run")
         return True
-    except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        print(f"Download {file_name} failed: {e}")
-        return False
+    return False
+
+# Download all files concurrently
+def download_files(files_to_download):
+    manifest = load_download_manifest()
+    architecture = get_system_architecture()
+
+    def _download(file_info):
+        expected_sha256 = manifest.get(file_info["fileName"]) or manifest.get(file_info["fileUrl"])
+        with profiler.span(f'download {file_info["fileName"]}', 'download', url=file_info["fileUrl"]):
+            return download_file(file_info["fileName"], file_info["fileUrl"], expected_sha256, architecture)
+
+    with ThreadPoolExecutor(max_workers=len(files_to_download), thread_name_prefix='download') as pool:
+        results = list(pool.map(_download, files_to_download))
+    return all(results)
 
 # Get files for architecture
 def get_files_for_architecture(architecture):
@@ -197,7 +1116,7 @@ def argo_type():
         tunnel_yml = f"""
 tunnel: {tunnel_id}
 credentials-file: {os.path.join(FILE_PATH, 'tunnel.json')}
-protocol: http2
+protocol: {ARGO_PROTOCOL}
 
 ingress:
   - hostname: {ARGO_DOMAIN}
@@ -211,47 +1130,11 @@ ingress:
     else:
         print("Use token connect to tunnel,please set the {ARGO_PORT} in cloudflare")
 
-# Execute shell command and return output
-def exec_cmd(command):
-    try:
-        process = subprocess.Popen(
-            command, 
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        stdout, stderr = process.communicate()
-        return stdout + stderr
-    except Exception as e:
-        print(f"Error executing command: {e}")
-        return str(e)
-
-# Download and run necessary files
-async def download_files_and_run():
-    global private_key, public_key
-    
-    architecture = get_system_architecture()
-    files_to_download = get_files_for_architecture(architecture)
-    
-    if not files_to_download:
-        print("Can't find a file for the current architecture")
-        return
-    
-    # Download all files
-    download_success = True
-    for file_info in files_to_download:
-        if not download_file(file_info["fileName"], file_info["fileUrl"]):
-            download_success = False
-    
-    if not download_success:
-        print("Error downloading files")
+# Generate config.yaml for nezha v1
+def write_nezha_config():
+    if not NEZHA_SERVER or not NEZHA_KEY or NEZHA_PORT:
         return
-    
-    # Authorize files
-    files_to_authorize = ['npm', 'web', 'bot'] if NEZHA_PORT else ['php', 'web', 'bot']
-    authorize_files(files_to_authorize)
-    
+
     # Check TLS
     port = NEZHA_SERVER.split(":")[-1] if ":" in NEZHA_SERVER else ""
     if port in ["443", "8443", "2096", "2087", "2083", "2053"]:
@@ -259,11 +1142,7 @@ async def download_files_and_run():
     else:
         nezha_tls = "false"
 
-    # Configure nezha
-    if NEZHA_SERVER and NEZHA_KEY:
-        if not NEZHA_PORT:
-            # Generate config.yaml for v1
-            config_yaml = f"""
+    config_yaml = f"""
 client_secret: {NEZHA_KEY}
 debug: false
 disable_auto_update: true
@@ -283,135 +1162,979 @@ tls: {nezha_tls}
 use_gitee_to_upgrade: false
 use_ipv6_country_code: false
 uuid: {UUID}"""
-            
-            with open(os.path.join(FILE_PATH, 'config.yaml'), 'w') as f:
-                f.write(config_yaml)
-    
-    # Generate configuration file
-    config ={"log":{"access":"/dev/null","error":"/dev/null","loglevel":"none",},"inbounds":[{"port":ARGO_PORT ,"protocol":"vless","settings":{"clients":[{"id":UUID ,"flow":"xtls-rprx-vision",},],"decryption":"none","fallbacks":[{"dest":3001 },{"path":"/vless-argo","dest":3002 },{"path":"/vmess-argo","dest":3003 },{"path":"/trojan-argo","dest":3004 },],},"streamSettings":{"network":"tcp",},},{"port":3001 ,"listen":"127.0.0.1","protocol":"vless","settings":{"clients":[{"id":UUID },],"decryption":"none"},"streamSettings":{"network":"ws","security":"none"}},{"port":3002 ,"listen":"127.0.0.1","protocol":"vless","settings":{"clients":[{"id":UUID ,"level":0 }],"decryption":"none"},"streamSettings":{"network":"ws","security":"none","wsSettings":{"path":"/vless-argo"}},"sniffing":{"enabled":True ,"destOverride":["http","tls","quic"],"metadataOnly":False }},{"port":3003 ,"listen":"127.0.0.1","protocol":"vmess","settings":{"clients":[{"id":UUID ,"alterId":0 }]},"streamSettings":{"network":"ws","wsSettings":{"path":"/vmess-argo"}},"sniffing":{"enabled":True ,"destOverride":["http","tls","quic"],"metadataOnly":False }},{"port":3004 ,"listen":"127.0.0.1","protocol":"trojan","settings":{"clients":[{"password":UUID },]},"streamSettings":{"network":"ws","security":"none","wsSettings":{"path":"/trojan-argo"}},"sniffing":{"enabled":True ,"destOverride":["http","tls","quic"],"metadataOnly":False }},],"outbounds":[{"protocol":"freedom","tag": "direct" },{"protocol":"blackhole","tag":"block"}]}
-    with open(os.path.join(FILE_PATH, 'config.json'), 'w', encoding='utf-8') as config_file:
-        json.dump(config, config_file, ensure_ascii=False, indent=2)
-    
-    # Run nezha
-    if NEZHA_SERVER and NEZHA_PORT and NEZHA_KEY:
-        tls_ports = ['443', '8443', '2096', '2087', '2083', '2053']
-        nezha_tls = '--tls' if NEZHA_PORT in tls_ports else ''
-        command = f"nohup {os.path.join(FILE_PATH, 'npm')} -s {NEZHA_SERVER}:{NEZHA_PORT} -p {NEZHA_KEY} {nezha_tls} >/dev/null 2>&1 &"
-        
-        try:
-            exec_cmd(command)
-            print('npm is running')
-            time.sleep(1)
-        except Exception as e:
-            print(f"npm running error: {e}")
-    
-    elif NEZHA_SERVER and NEZHA_KEY:
-        # Run V1
-        command = f"nohup {FILE_PATH}/php -c \"{FILE_PATH}/config.yaml\" >/dev/null 2>&1 &"
-        try:
-            exec_cmd(command)
-            print('php is running')
-            time.sleep(1)
-        except Exception as e:
-            print(f"php running error: {e}")
-    else:
-        print('NEZHA variable is empty, skipping running')
     
-    # Run sbX
-    command = f"nohup {os.path.join(FILE_PATH, 'web')} -c {os.path.join(FILE_PATH, 'config.json')} >/dev/null 2>&1 &"
+    with open(os.path.join(FILE_PATH, 'config.yaml'), 'w') as f:
+        f.write(config_yaml)
+
+# Typed pieces of the xray config, rendered to plain dicts for JSON
+@dataclass
+class Sniffing:
+    enabled: bool = True
+    dest_override: list = field(default_factory=lambda: ['http', 'tls', 'quic'])
+    metadata_only: bool = False
+
+    def to_dict(self):
+        if not self.enabled:
+            return {"enabled": False}
+        return {"enabled": True, "destOverride": self.dest_override, "metadataOnly": self.metadata_only}
+
+@dataclass
+class Inbound:
+    protocol: str
+    port: int
+    settings: dict
+    network: str = 'ws'
+    path: str = ''
+    listen: str = '127.0.0.1'
+    sniffing: Sniffing = None
+
+    def to_dict(self):
+        stream = {"network": self.network}
+        if self.network == 'ws':
+            stream["security"] = "none"
+            if self.path:
+                stream["wsSettings"] = {"path": self.path}
+        inbound = {"port": self.port, "protocol": self.protocol, "settings": self.settings, "streamSettings": stream}
+        if self.listen:
+            inbound["listen"] = self.listen
+        if self.sniffing:
+            inbound["sniffing"] = self.sniffing.to_dict()
+        return inbound
+
+@dataclass
+class Outbound:
+    protocol: str
+    tag: str
+
+    def to_dict(self):
+        return asdict(self)
+
+XRAY_PROTOCOL_ORDER = ('vless', 'vmess', 'trojan')
+
+def protocol_clients(protocol):
+    if protocol == 'vless':
+        return {"clients": [{"id": UUID, "level": 0}], "decryption": "none"}
+    if protocol == 'vmess':
+        return {"clients": [{"id": UUID, "alterId": 0}]}
+    return {"clients": [{"password": UUID}]}
+
+def requested_protocols():
+    return [p.strip().lower() for p in XRAY_PROTOCOLS.split(',') if p.strip()]
+
+def enabled_protocols():
+    requested = requested_protocols()
+    protocols = [p for p in XRAY_PROTOCOL_ORDER if p in requested]
+    return protocols or list(XRAY_PROTOCOL_ORDER)
+
+# Each protocol keeps a fixed port and path so toggling one never moves the others
+def protocol_port(protocol):
+    return XRAY_PORT_BASE + 1 + XRAY_PROTOCOL_ORDER.index(protocol)
+
+def protocol_path(protocol):
+    return f"/{protocol}-argo"
+
+def web_ports():
+    return [ARGO_PORT, XRAY_PORT_BASE] + [protocol_port(p) for p in enabled_protocols()]
+
+class XrayConfigBuilder:
+    def __init__(self):
+        self.inbounds = []
+        self.outbounds = []
+        self.policy = None
+
+    def add_inbound(self, inbound):
+        self.inbounds.append(inbound)
+        return self
+
+    def add_outbound(self, outbound):
+        self.outbounds.append(outbound)
+        return self
+
+    def set_buffer_size(self, kilobytes):
+        if kilobytes >= 0:
+            self.policy = {"levels": {"0": {"bufferSize": kilobytes}}}
+        return self
+
+    def build(self):
+        config = {
+            "log": {"access": "/dev/null", "error": "/dev/null", "loglevel": XRAY_LOGLEVEL},
+            "inbounds": [inbound.to_dict() for inbound in self.inbounds],
+            "outbounds": [outbound.to_dict() for outbound in self.outbounds],
+        }
+        if self.policy:
+            config["policy"] = self.policy
+        return config
+
+def build_xray_config():
+    protocols = enabled_protocols()
+    unknown = [p for p in requested_protocols() if p not in XRAY_PROTOCOL_ORDER]
+    if unknown:
+        print(f"Ignoring unsupported XRAY_PROTOCOLS entries: {', '.join(unknown)}")
+    sniffing = Sniffing(
+        enabled=XRAY_SNIFFING,
+        dest_override=[d.strip() for d in XRAY_SNIFF_DEST.split(',') if d.strip()],
+        metadata_only=XRAY_SNIFF_METADATA_ONLY,
+    )
+
+    # Argo lands on a plain vless listener that routes each ws path to its protocol
+    fallbacks = [{"dest": XRAY_PORT_BASE}] + [{"path": protocol_path(p), "dest": protocol_port(p)} for p in protocols]
+    builder = XrayConfigBuilder()
+    builder.add_inbound(Inbound('vless', ARGO_PORT, {"clients": [{"id": UUID, "flow": "xtls-rprx-vision"}], "decryption": "none", "fallbacks": fallbacks}, network='tcp', listen=''))
+    builder.add_inbound(Inbound('vless', XRAY_PORT_BASE, {"clients": [{"id": UUID}], "decryption": "none"}))
+    for protocol in protocols:
+        builder.add_inbound(Inbound(protocol, protocol_port(protocol), protocol_clients(protocol), path=protocol_path(protocol), sniffing=sniffing))
+    builder.add_outbound(Outbound('freedom', 'direct'))
+    builder.add_outbound(Outbound('blackhole', 'block'))
+    builder.set_buffer_size(XRAY_BUFFER_SIZE)
+    return builder.build()
+
+# Compact, key-sorted JSON so identical settings produce identical bytes
+def xray_config_json():
+    return json.dumps(build_xray_config(), ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+# Write config.json only when its content changed; returns True when rewritten
+def write_xray_config():
+    data = xray_config_json()
     try:
-        exec_cmd(command)
-        print('web is running')
-        time.sleep(1)
-    except Exception as e:
-        print(f"web running error: {e}")
-    
-    # Run cloudflared
-    if os.path.exists(os.path.join(FILE_PATH, 'bot')):
-        if re.match(r'^[A-Z0-9a-z=]{120,250}$', ARGO_AUTH):
-            args = f"tunnel --edge-ip-version auto --no-autoupdate --protocol http2 run --token {ARGO_AUTH}"
-        elif "TunnelSecret" in ARGO_AUTH:
-            args = f"tunnel --edge-ip-version auto --config {os.path.join(FILE_PATH, 'tunnel.yml')} run"
-        else:
-            args = f"tunnel --edge-ip-version auto --no-autoupdate --protocol http2 --logfile {os.path.join(FILE_PATH, 'boot.log')} --loglevel info --url http://localhost:{ARGO_PORT}"
-        
-        try:
-            exec_cmd(f"nohup {os.path.join(FILE_PATH, 'bot')} {args} >/dev/null 2>&1 &")
-            print('bot is running')
-            time.sleep(2)
-        except Exception as e:
-            print(f"Error executing command: {e}")
-    
-    time.sleep(5)
-    
-    # Extract domains and generate sub.txt
-    await extract_domains()
+        with open(config_path, 'r', encoding='utf-8') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    write_atomic(config_path, data)
+    return True
 
-# Extract domains from cloudflared logs
-async def extract_domains():
-    argo_domain = None
+# Read a growing log file incrementally, surviving truncation and re-creation
+class LogFollower:
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        self.pending = b''
 
-    if ARGO_AUTH and ARGO_DOMAIN:
-        argo_domain = ARGO_DOMAIN
-        print(f'ARGO_DOMAIN: {argo_domain}')
-        await generate_links(argo_domain)
-    else:
+    def read_lines(self):
         try:
-            with open(boot_log_path, 'r') as f:
-                file_content = f.read()
-            
-            lines = file_content.split('\n')
-            argo_domains = []
-            
-            for line in lines:
-                domain_match = re.search(r'https?://([^ ]*trycloudflare\.com)/?', line)
-                if domain_match:
-                    domain = domain_match.group(1)
-                    argo_domains.append(domain)
-            
-            if argo_domains:
-                argo_domain = argo_domains[0]
-                print(f'ArgoDomain: {argo_domain}')
-                await generate_links(argo_domain)
-            else:
-                print('ArgoDomain not found, re-running bot to obtain ArgoDomain')
-                # Remove boot.log and restart bot
-                if os.path.exists(boot_log_path):
-                    os.remove(boot_log_path)
-                
-                try:
-                    exec_cmd('pkill -f "[b]ot" > /dev/null 2>&1')
-                except:
-                    pass
-                
-                time.sleep(1)
-                args = f'tunnel --edge-ip-version auto --no-autoupdate --protocol http2 --logfile {FILE_PATH}/boot.log --loglevel info --url http://localhost:{ARGO_PORT}'
-                exec_cmd(f'nohup {os.path.join(FILE_PATH, "bot")} {args} >/dev/null 2>&1 &')
-                print('bot is running.')
-                time.sleep(6)  # Wait 6 seconds
-                await extract_domains()  # Try again
-        except Exception as e:
-            print(f'Error reading boot.log: {e}')
+            with open(self.path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_ino != self.inode or st.st_size < self.offset:
+                    # New or truncated file, start from the beginning
+                    self.inode, self.offset, self.pending = st.st_ino, 0, b''
+                f.seek(self.offset)
+                chunk = f.read()
+                self.offset = f.tell()
+        except FileNotFoundError:
+            return []
+
+        if not chunk:
+            return []
+        lines = (self.pending + chunk).split(b'\n')
+        self.pending = lines.pop()
+        return [line.decode('utf-8', errors='replace') for line in lines]
+
+# Follow a log file incrementally and return the first line matching pattern
+async def follow_log(path, pattern, timeout, poll_interval=0.2):
+    deadline = time.monotonic() + timeout
+    follower = LogFollower(path)
+
+    while True:
+        for line in follower.read_lines():
+            match = pattern.search(line)
+            if match:
+                return match
+
+        if time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(poll_interval)
+
+ARGO_DOMAIN_PATTERN = re.compile(r'https?://([^ ]*trycloudflare\.com)/?')
+BOT_READY_PATTERN = re.compile(r'Registered tunnel connection')
+
+async def port_open(port, host='127.0.0.1', timeout=0.5):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+# Readiness checks return None when satisfied, or the reason they are not
+def child_check(name):
+    async def check():
+        child = supervisor.get(name)
+        if child and child.alive():
+            return None
+        return f'{name} is not running'
+    return check
+
+def port_check(ports):
+    async def check():
+        for port in ports:
+            if not await port_open(port):
+                return f'port {port} is not accepting connections'
+        return None
+    return check
+
+def log_check(path, pattern):
+    follower = LogFollower(path)
+    seen = []
+    async def check():
+        if not seen:
+            seen.extend(line for line in follower.read_lines() if pattern.search(line))
+        if seen:
+            return None
+        return f'"{pattern.pattern}" not found in {os.path.basename(path)}'
+    return check
+
+# Wait until every check passes, report how long it took or why it did not
+async def wait_until_ready(name, checks, timeout=READY_TIMEOUT, interval=0.1):
+    with profiler.span(f'ready {name}', 'wait'):
+        return await poll_ready(name, checks, timeout, interval)
+
+async def poll_ready(name, checks, timeout, interval):
+    started = time.monotonic()
+    while True:
+        reason = None
+        for check in checks:
+            reason = await check()
+            if reason:
+                break
+
+        elapsed = time.monotonic() - started
+        if reason is None:
+            print(f'{name} is ready in {elapsed:.2f}s')
+            return True
+        if elapsed >= timeout:
+            print(f'{name} is NOT ready after {timeout}s: {reason}')
+            return False
+        await asyncio.sleep(interval)
+
+# Parse a CPU list such as "0-1,3" into a sorted list of CPU numbers
+def parse_cpu_list(value):
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+IONICE_CLASSES = {
+    'none': psutil.IOPRIO_CLASS_NONE,
+    'rt': psutil.IOPRIO_CLASS_RT,
+    'be': psutil.IOPRIO_CLASS_BE,
+    'idle': psutil.IOPRIO_CLASS_IDLE,
+}
+
+# Parse "idle", "be:7" or "rt:0" into an ionice class and level
+def parse_ionice(value):
+    io_class, _, level = value.lower().partition(':')
+    if io_class not in IONICE_CLASSES:
+        raise ValueError(f"unknown ionice class {io_class}")
+    return (io_class, int(level) if level else None)
+
+IONICE_NAMES = {int(value): name for name, value in IONICE_CLASSES.items()}
+
+# Scheduling and rlimit settings for one child, applied through psutil right after spawn
+@dataclass
+class ResourceLimits:
+    cpu_affinity: list = None
+    nice: int = None
+    ionice: tuple = None
+    nofile: int = None
+    memory_mb: int = None
+
+    @classmethod
+    def from_env(cls, prefix):
+        parsers = {
+            'cpu_affinity': ('CPU_AFFINITY', parse_cpu_list),
+            'nice': ('NICE', lambda value: max(-20, min(19, int(value)))),
+            'ionice': ('IONICE', parse_ionice),
+            'nofile': ('NOFILE', int),
+            'memory_mb': ('MEMORY_MB', int),
+        }
+        limits = cls()
+        for attr, (key, parse) in parsers.items():
+            value = os.environ.get(f'{prefix}_{key}', '').strip()
+            if not value:
+                continue
+            try:
+                setattr(limits, attr, parse(value))
+            except ValueError as e:
+                print(f"Ignoring invalid {prefix}_{key}={value}: {e}")
+        return limits
+
+    # Every setting is applied on its own so one refusal (e.g. a negative nice without
+    # CAP_SYS_NICE) does not skip the rest; returns (setting, error) for each failure
+    def apply(self, pid):
+        process = psutil.Process(pid)
+        steps = {
+            'cpu_affinity': self.apply_cpu_affinity,
+            'nice': self.apply_nice,
+            'ionice': self.apply_ionice,
+            'nofile': self.apply_nofile,
+            'memory_mb': self.apply_memory,
+        }
+        failures = []
+        for setting, step in steps.items():
+            try:
+                step(process)
+            except (psutil.Error, OSError) as e:
+                failures.append((setting, e))
+        return failures
+
+    def apply_cpu_affinity(self, process):
+        if self.cpu_affinity:
+            available = set(psutil.Process().cpu_affinity())
+            cpus = [cpu for cpu in self.cpu_affinity if cpu in available]
+            if cpus:
+                process.cpu_affinity(cpus)
+            else:
+                print(f"None of CPUs {self.cpu_affinity} are available, affinity unchanged")
+
+    def apply_nice(self, process):
+        if self.nice is not None:
+            process.nice(self.nice)
+
+    def apply_ionice(self, process):
+        if self.ionice:
+            io_class, level = self.ionice
+            if io_class in ('rt', 'be'):
+                process.ionice(IONICE_CLASSES[io_class], 4 if level is None else level)
+            else:
+                process.ionice(IONICE_CLASSES[io_class])
+
+    def apply_nofile(self, process):
+        if self.nofile:
+            # Unprivileged processes can only lower the hard limit
+            _, hard = process.rlimit(psutil.RLIMIT_NOFILE)
+            if hard != psutil.RLIM_INFINITY and self.nofile > hard:
+                print(f"RLIMIT_NOFILE {self.nofile} is above the hard limit {hard}, using {hard}")
+            limit = self.nofile if hard == psutil.RLIM_INFINITY else min(self.nofile, hard)
+            process.rlimit(psutil.RLIMIT_NOFILE, (limit, limit))
+
+    def apply_memory(self, process):
+        if self.memory_mb:
+            limit = self.memory_mb * 1024 * 1024
+            process.rlimit(psutil.RLIMIT_AS, (limit, limit))
+
+# What the kernel actually applied to a running child
+def effective_resources(pid):
+    try:
+        process = psutil.Process(pid)
+        io = process.ionice()
+        memory = process.rlimit(psutil.RLIMIT_AS)[0]
+        return {
+            "cpu_affinity": process.cpu_affinity(),
+            "nice": process.nice(),
+            "ionice": {"class": IONICE_NAMES.get(int(io.ioclass), int(io.ioclass)), "value": io.value},
+            "nofile": process.rlimit(psutil.RLIMIT_NOFILE)[0],
+            "memory_mb": None if memory == psutil.RLIM_INFINITY else memory // (1024 * 1024),
+        }
+    except (psutil.Error, OSError):
+        return {}
+
+WEB_LIMITS = ResourceLimits.from_env('WEB')
+BOT_LIMITS = ResourceLimits.from_env('BOT')
+NEZHA_LIMITS = ResourceLimits.from_env('NEZHA')
+
+# Binaries are tens of MB, hash each file version once per process
+binary_hashes = {}
+
+def cached_sha256(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key not in binary_hashes:
+        binary_hashes[key] = file_sha256(path)
+    return binary_hashes[key]
+
+# The live process behind a state.json record, None when it exited or the pid was reused
+def recorded_process(record):
+    try:
+        process = psutil.Process(record["pid"])
+        if abs(process.create_time() - (record["create_time"] or 0)) < 0.01:
+            if process.status() != psutil.STATUS_ZOMBIE:
+                return process
+    except (psutil.Error, KeyError, TypeError):
+        pass
+    return None
+
+# Popen-like handle for a child left running by a previous app.py
+class AdoptedProcess:
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                if self.process.is_running() and self.process.status() != psutil.STATUS_ZOMBIE:
+                    return None
+            except psutil.NoSuchProcess:
+                pass
+            # Only the original parent can see the exit status
+            self.returncode = -1
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self.process.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+    def wait(self, timeout=None):
+        try:
+            self.process.wait(timeout)
+        except psutil.TimeoutExpired:
+            raise subprocess.TimeoutExpired(self.process.name(), timeout)
+        except psutil.NoSuchProcess:
+            pass
+        self.returncode = -1 if self.returncode is None else self.returncode
+        return self.returncode
+
+# A child process owned by the supervisor
+class ManagedProcess:
+    def __init__(self, name, argv, prepare=None, limits=None, config=None):
+        self.name = name
+        self.argv = argv
+        self.prepare = prepare
+        self.limits = limits
+        self.config = config
+        self.adopted = False
+        self.create_time = None
+        self.cmdline = None
+        self.binary_sha256 = None
+        self.config_sha256 = None
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_exit = None
+        self.next_start = None
+        self.stopped = False
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def uptime(self):
+        if not self.alive():
+            return 0
+        return time.monotonic() - self.started_at
+
+    def status(self):
+        return {
+            "pid": self.pid,
+            "alive": self.alive(),
+            "uptime": round(self.uptime(), 1),
+            "restarts": self.restarts,
+            "last_exit": self.last_exit,
+            "adopted": self.adopted,
+            "resources": effective_resources(self.pid) if self.alive() else {},
+        }
+
+    # What the next app.py needs to recognise this child and decide whether it still fits
+    def record(self):
+        return {
+            "pid": self.pid,
+            "create_time": self.create_time,
+            "cmdline": self.cmdline,
+            "argv": self.argv,
+            "binary_sha256": self.binary_sha256,
+            "config_sha256": self.config_sha256,
+        }
+
+# Spawn children without a shell, reap them and restart them with exponential backoff
+class Supervisor:
+    STABLE_UPTIME = 60
+
+    def __init__(self, poll_interval=0.5):
+        self.poll_interval = poll_interval
+        self.children = {}
+        self.adoptable = {}
+        self.on_change = None
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def get(self, name):
+        return self.children.get(name)
+
+    def start(self, name, argv, prepare=None, limits=None, config=None):
+        with self.lock:
+            old = self.children.get(name)
+            if old:
+                self.terminate(old)
+            child = ManagedProcess(name, argv, prepare, limits, config)
+            self.children[name] = child
+            record = self.adoptable.pop(name, None)
+            if not (record and self.adopt(child, record)):
+                self.spawn(child)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.monitor, name='supervisor', daemon=True)
+                self.thread.start()
+            return child
+
+    def spawn(self, child):
+        with profiler.span(f'spawn {child.name}', 'spawn'):
+            if child.prepare:
+                child.prepare()
+            child.process = subprocess.Popen(
+                child.argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+            self.apply_limits(child)
+        child.started_at = time.monotonic()
+        child.next_start = None
+        child.adopted = False
+        # Scripts show up with their interpreter, so remember the command line as the kernel reports it
+        try:
+            process = psutil.Process(child.pid)
+            child.create_time, child.cmdline = process.create_time(), process.cmdline()
+        except psutil.Error:
+            child.create_time, child.cmdline = None, None
+        child.binary_sha256 = cached_sha256(child.argv[0])
+        child.config_sha256 = cached_sha256(child.config) if child.config else None
+        self.changed()
+
+    def apply_limits(self, child):
+        if child.limits and child.limits != ResourceLimits():
+            try:
+                for setting, error in child.limits.apply(child.pid):
+                    print(f"Failed to apply {setting} to {child.name}: {error}")
+                print(f"{child.name} resources: {effective_resources(child.pid)}")
+            except (psutil.Error, OSError) as e:
+                print(f"Failed to apply resource limits to {child.name}: {e}")
+
+    # Take over a child recorded by a previous run if it is the same process running the same binary and config
+    def adopt(self, child, record):
+        process = recorded_process(record)
+        if process is None:
+            print(f"{child.name} from the previous run is gone, starting a new one")
+            return False
+
+        if child.prepare:
+            child.prepare()
+        binary_sha256 = cached_sha256(child.argv[0])
+        config_sha256 = cached_sha256(child.config) if child.config else None
+        try:
+            running_cmdline = process.cmdline()
+        except psutil.Error:
+            running_cmdline = None
+        mismatched = [reason for reason, ok in (
+            ('command line', record["argv"] == child.argv and running_cmdline == record.get("cmdline")),
+            ('binary', record["binary_sha256"] == binary_sha256),
+            ('config', record["config_sha256"] == config_sha256),
+        ) if not ok]
+        if mismatched:
+            print(f"Replacing {child.name} (pid {process.pid}), its {', '.join(mismatched)} changed")
+            self.stop_stale(process)
+            return False
+
+        child.process = AdoptedProcess(process)
+        child.adopted = True
+        child.create_time, child.cmdline = record["create_time"], record["cmdline"]
+        child.started_at = time.monotonic() - max(0, time.time() - record["create_time"])
+        child.binary_sha256 = binary_sha256
+        child.config_sha256 = config_sha256
+        self.apply_limits(child)
+        print(f"{child.name} adopted from the previous run, pid {child.pid}")
+        self.changed()
+        return True
+
+    # Recorded children that this run did not start again are no longer wanted
+    def release_unclaimed(self):
+        with self.lock:
+            for name, record in self.adoptable.items():
+                process = recorded_process(record)
+                if process:
+                    print(f"Stopping {name} (pid {process.pid}) left over from the previous run")
+                    self.stop_stale(process)
+            self.adoptable = {}
+        self.changed()
+
+    def stop_stale(self, process, timeout=5):
+        handle = AdoptedProcess(process)
+        handle.terminate()
+        try:
+            handle.wait(timeout)
+        except subprocess.TimeoutExpired:
+            handle.kill()
+            handle.wait()
+
+    def changed(self):
+        if self.on_change:
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f"Error saving supervisor state: {e}")
+
+    def restart(self, name):
+        with self.lock:
+            child = self.children.get(name)
+            if child is None:
+                return
+            self.terminate(child)
+            child.stopped = False
+            child.restarts += 1
+            self.spawn(child)
+
+    def terminate(self, child, timeout=5):
+        child.stopped = True
+        if not child.alive():
+            return
+        child.process.terminate()
+        try:
+            child.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            child.process.kill()
+            child.process.wait()
+
+    def stop_all(self):
+        self.stopping.set()
+        with self.lock:
+            for child in self.children.values():
+                self.terminate(child)
+
+    def monitor(self):
+        while not self.stopping.wait(self.poll_interval):
+            with self.lock:
+                for child in self.children.values():
+                    self.check(child)
+
+    def check(self, child):
+        if child.stopped or child.process is None:
+            return
+
+        if child.next_start is None:
+            code = child.process.poll()
+            if code is None:
+                return
+            uptime = time.monotonic() - child.started_at
+            child.last_exit = code
+            child.failures = 0 if uptime >= self.STABLE_UPTIME else child.failures + 1
+            delay = min(2 ** (child.failures - 1), RESTART_BACKOFF_MAX) if child.failures else 0
+            child.next_start = time.monotonic() + delay
+            print(f"{child.name} exited with code {code} after {uptime:.0f}s, restarting in {delay}s")
+
+        if time.monotonic() >= child.next_start:
+            try:
+                self.spawn(child)
+                child.restarts += 1
+                print(f"{child.name} restarted, pid {child.pid}, {child.restarts} restarts so far")
+            except Exception as e:
+                child.failures += 1
+                child.next_start = time.monotonic() + min(2 ** child.failures, RESTART_BACKOFF_MAX)
+                print(f"{child.name} restart failed: {e}")
+
+    def status(self):
+        with self.lock:
+            return {name: child.status() for name, child in self.children.items()}
+
+    # Running children, plus recorded ones from the previous run that were not claimed yet
+    def records(self):
+        with self.lock:
+            records = dict(self.adoptable)
+            records.update({name: child.record() for name, child in self.children.items() if child.alive()})
+            return records
+
+    # Stop supervising but leave the children running for the next app.py to adopt
+    def detach(self):
+        self.stopping.set()
+        with self.lock:
+            running = [name for name, child in self.children.items() if child.alive()]
+        print(f"Leaving {', '.join(running) or 'no children'} running for the next start")
+
+supervisor = Supervisor()
+
+# Put a binary removed by clean_files() back from the artifact cache before a restart
+def restore_binary(file_name):
+    file_path = os.path.join(FILE_PATH, file_name)
+    if os.path.exists(file_path):
+        return
+    architecture = get_system_architecture()
+    for file_info in get_files_for_architecture(architecture):
+        if file_info["fileName"] == file_name:
+            entry = artifact_cache.lookup(file_info["fileUrl"], architecture)
+            if entry:
+                artifact_cache.link(entry, file_path)
+                os.chmod(file_path, 0o775)
+            return
+
+def prepare_web():
+    restore_binary('web')
+    if not os.path.exists(config_path):
+        write_xray_config()
+
+# Run nezha
+async def run_nezha():
+    if NEZHA_SERVER and NEZHA_PORT and NEZHA_KEY:
+        tls_ports = ['443', '8443', '2096', '2087', '2083', '2053']
+        argv = [npm_path, '-s', f'{NEZHA_SERVER}:{NEZHA_PORT}', '-p', NEZHA_KEY]
+        if NEZHA_PORT in tls_ports:
+            argv.append('--tls')
+        
+        try:
+            await asyncio.to_thread(supervisor.start, 'npm', argv, prepare=lambda: restore_binary('npm'), limits=NEZHA_LIMITS)
+            print('npm is running')
+            await wait_until_ready('npm', [child_check('npm')])
+        except Exception as e:
+            print(f"npm running error: {e}")
+    
+    elif NEZHA_SERVER and NEZHA_KEY:
+        # Run V1
+        argv = [php_path, '-c', os.path.join(FILE_PATH, 'config.yaml')]
+        try:
+            await asyncio.to_thread(supervisor.start, 'php', argv, prepare=lambda: restore_binary('php'), limits=NEZHA_LIMITS, config=argv[2])
+            print('php is running')
+            await wait_until_ready('php', [child_check('php')])
+        except Exception as e:
+            print(f"php running error: {e}")
+    else:
+        print('NEZHA variable is empty, skipping running')
+
+WEB_PORTS = web_ports()
+
+# Run sbX
+async def run_web():
+    try:
+        await asyncio.to_thread(supervisor.start, 'web', [web_path, '-c', config_path], prepare=prepare_web, limits=WEB_LIMITS, config=config_path)
+        print('web is running')
+        await wait_until_ready('web', [child_check('web'), port_check(WEB_PORTS)])
+    except Exception as e:
+        print(f"web running error: {e}")
+
+# Run cloudflared
+# Connector names and their logs: bot/boot.log, bot-1/boot-1.log, ...
+def tunnel_names():
+    return ['bot'] + [f'bot-{i}' for i in range(1, ARGO_TUNNELS)]
+
+def tunnel_log_path(name):
+    if name == 'bot':
+        return boot_log_path
+    return os.path.join(FILE_PATH, f'boot-{name.split("-", 1)[1]}.log')
+
+def is_quick_tunnel():
+    return not (ARGO_AUTH and ARGO_DOMAIN)
+
+def tunnel_args(name):
+    # Every mode logs to its own file so readiness can be read from it
+    log_args = ['--logfile', tunnel_log_path(name), '--loglevel', 'info']
+    if re.match(r'^[A-Z0-9a-z=]{120,250}$', ARGO_AUTH):
+        return ['tunnel', '--edge-ip-version', 'auto', '--no-autoupdate', '--protocol', ARGO_PROTOCOL, *log_args, 'run', '--token', ARGO_AUTH]
+    elif "TunnelSecret" in ARGO_AUTH:
+        return ['tunnel', '--edge-ip-version', 'auto', *log_args, '--config', os.path.join(FILE_PATH, 'tunnel.yml'), 'run']
+    return ['tunnel', '--edge-ip-version', 'auto', '--no-autoupdate', '--protocol', ARGO_PROTOCOL, *log_args, '--url', f'http://localhost:{ARGO_PORT}']
+
+# Every spawn starts from an empty log, so discovery never reads a domain from an earlier process.
+# A supervisor restart gives a quick tunnel connector a new domain, so look it up again.
+def prepare_tunnel(name):
+    restore_binary('bot')
+    try:
+        os.remove(tunnel_log_path(name))
+    except FileNotFoundError:
+        pass
+    if not is_quick_tunnel() or name not in tunnel_domains:
+        return
+    tunnel_domains.pop(name)
+    if main_loop is not None:
+        asyncio.run_coroutine_threadsafe(rediscover_tunnel(name), main_loop)
+
+async def start_tunnel(name):
+    config = os.path.join(FILE_PATH, 'tunnel.yml') if "TunnelSecret" in ARGO_AUTH else None
+    try:
+        # Adoption may hash binaries or stop a stale process, keep that off the event loop
+        child = await asyncio.to_thread(supervisor.start, name, [bot_path, *tunnel_args(name)],
+                                        prepare=lambda: prepare_tunnel(name), limits=BOT_LIMITS, config=config)
+        print(f'{name} is running')
+        # An adopted connector registered long ago and its log may be gone
+        checks = [child_check(name)] if child.adopted else [child_check(name), log_check(tunnel_log_path(name), BOT_READY_PATTERN)]
+        await wait_until_ready(name, checks)
+    except Exception as e:
+        print(f"Error executing command: {e}")
+
+# Named tunnels run the connectors as replicas of one tunnel, quick tunnels get a domain each
+async def run_bot():
+    if not os.path.exists(bot_path):
+        return
+
+    await asyncio.gather(*(start_tunnel(name) for name in tunnel_names()))
+
+# Download and run necessary files
+async def download_files_and_run():
+    architecture = get_system_architecture()
+    files_to_download = get_files_for_architecture(architecture)
+    
+    if not files_to_download:
+        print("Can't find a file for the current architecture")
+        return False
+    
+    # Download all files while the configs are generated
+    download_success, _ = await asyncio.gather(
+        timed('download', asyncio.to_thread(download_files, files_to_download)),
+        timed('config', asyncio.gather(
+            asyncio.to_thread(write_nezha_config),
+            asyncio.to_thread(write_xray_config),
+        )),
+    )
+    if not download_success:
+        print("Error downloading files")
+        return False
+    
+    # Authorize files
+    files_to_authorize = ['npm', 'web', 'bot'] if NEZHA_PORT else ['php', 'web', 'bot']
+    authorize_files(files_to_authorize)
+    
+    # Start nezha, web and bot side by side
+    with stage('spawn'):
+        await asyncio.gather(run_nezha(), run_web(), run_bot())
+    return True
+
+# Restart the quick tunnel with a fresh boot.log
+async def restart_quick_tunnel(name):
+    log_path = tunnel_log_path(name)
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    
+    await asyncio.to_thread(supervisor.restart, name)
+    print(f'{name} is running.')
+
+# Wait for a quick tunnel connector to print its trycloudflare domain
+async def discover_quick_tunnel_domain(name='bot'):
+    log_path = tunnel_log_path(name)
+    for attempt in range(ARGO_DISCOVERY_RETRIES + 1):
+        try:
+            started = time.monotonic()
+            domain_match = await follow_log(log_path, ARGO_DOMAIN_PATTERN, ARGO_DISCOVERY_TIMEOUT)
+        except Exception as e:
+            print(f'Error reading {os.path.basename(log_path)}: {e}')
+            domain_match = None
+
+        if domain_match:
+            argo_domain = domain_match.group(1)
+            print(f'ArgoDomain ({name}): {argo_domain} (found in {time.monotonic() - started:.1f}s)')
+            return argo_domain
+
+        if attempt < ARGO_DISCOVERY_RETRIES:
+            print(f'ArgoDomain not found within {ARGO_DISCOVERY_TIMEOUT}s, re-running {name} to obtain ArgoDomain ({attempt + 1}/{ARGO_DISCOVERY_RETRIES})')
+            await restart_quick_tunnel(name)
+
+    print(f'ArgoDomain not found for {name} after {ARGO_DISCOVERY_RETRIES + 1} attempts, please check the tunnel')
+    return None
+
+main_loop = None
+tunnel_domains = {}
+previous_state = {}
+state_lock = threading.Lock()
+
+# Children, their binary/config hashes and the tunnel domains, for the next start to adopt
+def save_state():
+    children = supervisor.records()
+    state = {
+        "owner": {"pid": os.getpid(), "create_time": psutil.Process().create_time()},
+        "children": children,
+        "tunnel_domains": dict(tunnel_domains),
+        "links_version": current_links_version(),
+        "saved_at": time.time(),
+    }
+    with state_lock:
+        write_atomic(state_path, json.dumps(state, indent=2))
+
+# pid of another app.py that still runs the recorded children, None when they are free to adopt
+def live_owner(state):
+    owner = state.get("owner") or {}
+    if owner.get("pid") in (None, os.getpid()):
+        return None
+    try:
+        process = psutil.Process(owner["pid"])
+        if abs(process.create_time() - owner["create_time"]) < 0.01:
+            return process.pid
+    except (psutil.Error, KeyError, TypeError):
+        pass
+    return None
+
+def load_state():
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+supervisor.on_change = save_state
+
+# Domains in connector order, what the subscription is built from
+def current_domains():
+    if not is_quick_tunnel():
+        return [ARGO_DOMAIN]
+    return [tunnel_domains[name] for name in tunnel_names() if name in tunnel_domains]
+
+async def rediscover_tunnel(name):
+    argo_domain = await discover_quick_tunnel_domain(name)
+    if argo_domain:
+        tunnel_domains[name] = argo_domain
+    save_state()
+    domains = current_domains()
+    if domains:
+        await generate_links(domains)
+
+# Extract domains from cloudflared logs
+async def extract_domains():
+    if not is_quick_tunnel():
+        print(f'ARGO_DOMAIN: {ARGO_DOMAIN}')
+    else:
+        # Adopted connectors keep the domain they had before the restart
+        previous_domains = previous_state.get("tunnel_domains", {})
+        for name in tunnel_names():
+            child = supervisor.get(name)
+            if child and child.adopted and name in previous_domains:
+                tunnel_domains[name] = previous_domains[name]
+                print(f'ArgoDomain ({name}): {previous_domains[name]} (adopted)')
+
+        with stage('tunnel'):
+            names = [name for name in tunnel_names() if name not in tunnel_domains]
+            found = await asyncio.gather(*(discover_quick_tunnel_domain(name) for name in names))
+        for name, argo_domain in zip(names, found):
+            if argo_domain:
+                tunnel_domains[name] = argo_domain
+        save_state()
+
+    domains = current_domains()
+    if not domains:
+        return
+    await generate_links(domains)
+
+    ensure_reprobe()
 
 # Upload nodes to subscription service
 def upload_nodes():
     if UPLOAD_URL and PROJECT_URL:
         subscription_url = f"{PROJECT_URL}/{SUB_PATH}"
-        json_data = {
-            "subscription": [subscription_url]
-        }
-        
-        try:
-            response = requests.post(
-                f"{UPLOAD_URL}/api/add-subscriptions",
-                json=json_data,
-                headers={"Content-Type": "application/json"}
-            )
-            
+
+        def _uploaded(response):
             if response.status_code == 200:
                 print('Subscription uploaded successfully')
-        except Exception as e:
-            pass
+
+        outbound.submit_batch(f"{UPLOAD_URL}/api/add-subscriptions", "subscription", [subscription_url],
+                              label='upload subscription', on_response=_uploaded)
     
     elif UPLOAD_URL:
         if not os.path.exists(list_path):
@@ -424,20 +2147,12 @@ def upload_nodes():
         
         if not nodes:
             return
-        
-        json_data = json.dumps({"nodes": nodes})
-        
-        try:
-            response = requests.post(
-                f"{UPLOAD_URL}/api/add-nodes",
-                data=json_data,
-                headers={"Content-Type": "application/json"}
-            )
-            
+
+        def _uploaded(response):
             if response.status_code == 200:
                 print('Nodes uploaded successfully')
-        except:
-            return None
+
+        outbound.submit_batch(f"{UPLOAD_URL}/api/add-nodes", "nodes", nodes, label='upload nodes', on_response=_uploaded)
     else:
         return
     
@@ -461,40 +2176,205 @@ def send_telegram():
             "parse_mode": "MarkdownV2"
         }
         
-        requests.post(url, params=params)
-        print('Telegram message sent successfully')
+        outbound.submit('POST', url, 'send Telegram message', params=params,
+                        on_response=lambda response: print('Telegram message sent successfully'))
     except Exception as e:
         print(f'Failed to send Telegram message: {e}')
 
+# Look up the ISP name shown in node names
+def fetch_isp():
+    response = outbound.request('GET', 'https://speed.cloudflare.com/meta', timeout=5, retries=1)
+    response.raise_for_status()
+    meta = response.json()
+    return f"{meta.get('country', '')}-{meta.get('asOrganization', '')}".replace(' ', '_').strip('-_ ')
+
+# ISP_NAME wins, then a fresh cache entry, then a live lookup, then a stale cache entry
+def load_isp():
+    if ISP_NAME:
+        return ISP_NAME
+
+    cached = None
+    try:
+        with open(isp_cache_path, 'r') as f:
+            cached = json.load(f)
+        if time.time() - cached["fetched_at"] < ISP_CACHE_TTL:
+            return cached["isp"]
+    except (OSError, ValueError, KeyError, TypeError):
+        cached = None
+
+    try:
+        isp = fetch_isp()
+        if isp:
+            write_atomic(isp_cache_path, json.dumps({"isp": isp, "fetched_at": time.time()}))
+            return isp
+    except Exception as e:
+        print(f"ISP lookup failed: {e}")
+
+    return cached["isp"] if cached else 'Unknown'
+
+async def get_isp():
+    return await asyncio.to_thread(load_isp)
+
+isp_lookup = None
+
+# Start the ISP lookup once, early in startup, so it overlaps with downloads
+def start_isp_lookup():
+    global isp_lookup
+    if isp_lookup is None:
+        isp_lookup = asyncio.ensure_future(get_isp())
+    return isp_lookup
+
+# Candidate edge endpoints from CFIP_LIST/CFPORT_LIST, falling back to CFIP:CFPORT
+def get_candidate_endpoints():
+    hosts = [host.strip() for host in CFIP_LIST.split(',') if host.strip()] or [CFIP]
+    ports = [int(port) for port in CFPORT_LIST.split(',') if port.strip()] or [CFPORT]
+    endpoints = []
+    for host in hosts:
+        if host.startswith('['):
+            address, _, port = host[1:].partition(']:')
+            candidates = [(address.rstrip(']'), int(port))] if port else [(address.rstrip(']'), p) for p in ports]
+        elif host.count(':') == 1:
+            address, port = host.split(':')
+            candidates = [(address, int(port))]
+        else:
+            candidates = [(host, port) for port in ports]
+        for endpoint in candidates:
+            if endpoint not in endpoints:
+                endpoints.append(endpoint)
+    return endpoints
+
+# Time a TCP connect plus TLS handshake to an edge endpoint, None when unreachable
+async def probe_endpoint(host, port, server_name, attempts=2, timeout=3):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    best = None
+    for _ in range(attempts):
+        started = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context, server_hostname=server_name), timeout)
+        except (OSError, asyncio.TimeoutError):
+            continue
+        elapsed = time.perf_counter() - started
+        writer.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+ranked_endpoints = []
+
+# Probe every candidate concurrently and order them by handshake latency
+async def rank_endpoints(server_name):
+    candidates = get_candidate_endpoints()
+    if len(candidates) == 1:
+        return candidates
+
+    with profiler.span('probe edge endpoints', 'http'):
+        latencies = await asyncio.gather(*(probe_endpoint(host, port, server_name) for host, port in candidates))
+    previous = {endpoint: i for i, endpoint in enumerate(ranked_endpoints)}
+    reachable = [(latency, endpoint) for latency, endpoint in zip(latencies, candidates) if latency is not None]
+    if not reachable:
+        print("No edge endpoint answered the probe, keeping the configured order")
+        return candidates[:CFIP_TOP] if CFIP_TOP else candidates
+
+    # 25ms buckets with the previous position as tie-breaker keep jitter from reshuffling links
+    reachable.sort(key=lambda item: (int(item[0] * 1000) // 25, previous.get(item[1], len(previous))))
+    ranking = [endpoint for _, endpoint in reachable]
+    print("Edge latency: " + ", ".join(f"{host}:{port} {latency * 1000:.0f}ms" for latency, (host, port) in reachable))
+    return ranking[:CFIP_TOP] if CFIP_TOP else ranking
+
+# Re-probe on a schedule, generate_links() only rewrites sub.txt when the order changed
+async def reprobe_endpoints():
+    while True:
+        await asyncio.sleep(CFIP_PROBE_INTERVAL)
+        domains = current_domains()
+        if not domains:
+            continue
+        try:
+            await generate_links(domains)
+        except Exception as e:
+            print(f"Error refreshing edge endpoints: {e}")
+
+# Start the re-probe loop once there is more than one candidate, e.g. after a reload widened CFIP
+reprobe_task = None
+
+def ensure_reprobe():
+    global reprobe_task
+    if reprobe_task and not reprobe_task.done():
+        return
+    if CFIP_PROBE_INTERVAL > 0 and len(get_candidate_endpoints()) > 1:
+        reprobe_task = asyncio.create_task(reprobe_endpoints())
+        background_tasks.add(reprobe_task)
+
+# Hash of everything the subscription is derived from
+def links_version(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def current_links_version():
+    try:
+        with open(links_state_path, 'r') as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+# Node model for every argo domain over a ranked list of edge endpoints
+def build_nodes(argo_domains, ISP, endpoints):
+    nodes = []
+    for index, argo_domain in enumerate(argo_domains):
+        for host, port in endpoints:
+            label = f"{NAME}-{ISP}" if len(endpoints) == 1 else f"{NAME}-{ISP}-{host}-{port}"
+            if len(argo_domains) > 1:
+                label += f"-argo{index + 1}"
+            for protocol in enabled_protocols():
+                nodes.append({
+                    "type": protocol,
+                    "name": label,
+                    "server": host,
+                    "port": port,
+                    "uuid": UUID,
+                    "host": argo_domain,
+                    "sni": argo_domain,
+                    "path": protocol_path(protocol),
+                    "fp": "chrome",
+                })
+    return nodes
+
 # Generate links and subscription content
-async def generate_links(argo_domain):
-    meta_info = subprocess.run(['curl', '-s', 'https://speed.cloudflare.com/meta'], capture_output=True, text=True)
-    meta_info = meta_info.stdout.split('"')
-    ISP = f"{meta_info[25]}-{meta_info[17]}".replace(' ', '_').strip()
+async def generate_links(argo_domains):
+    global ranked_endpoints
+    with stage('links'):
+        ISP, endpoints = await asyncio.gather(start_isp_lookup(), rank_endpoints(argo_domains[0]))
+        ranked_endpoints = endpoints
+        inputs = {"uuid": UUID, "endpoints": endpoints, "domains": argo_domains, "isp": ISP, "name": NAME, "protocols": enabled_protocols()}
+        version = links_version(inputs)
 
-    time.sleep(2)
-    VMESS = {"v": "2", "ps": f"{NAME}-{ISP}", "add": CFIP, "port": CFPORT, "id": UUID, "aid": "0", "scy": "none", "net": "ws", "type": "none", "host": argo_domain, "path": "/vmess-argo?ed=2560", "tls": "tls", "sni": argo_domain, "alpn": "", "fp": "chrome"}
- 
-    list_txt = f"""
-vless://{UUID}@{CFIP}:{CFPORT}?encryption=none&security=tls&sni={argo_domain}&fp=chrome&type=ws&host={argo_domain}&path=%2Fvless-argo%3Fed%3D2560#{NAME}-{ISP}
-  
-vmess://{ base64.b64encode(json.dumps(VMESS).encode('utf-8')).decode('utf-8')}
+        nodes = build_nodes(argo_domains, ISP, endpoints)
+        list_txt = render_raw(nodes)
+        sub_txt = render_base64(nodes)
 
-trojan://{UUID}@{CFIP}:{CFPORT}?security=tls&sni={argo_domain}&fp=chrome&type=ws&host={argo_domain}&path=%2Ftrojan-argo%3Fed%3D2560#{NAME}-{ISP}
-    """
-    
-    with open(os.path.join(FILE_PATH, 'list.txt'), 'w', encoding='utf-8') as list_file:
-        list_file.write(list_txt)
+        if version == current_links_version() and os.path.exists(sub_path) and os.path.exists(nodes_path):
+            # list.txt may have been removed by clean_files(), restoring it is not a change
+            if not os.path.exists(list_path):
+                write_atomic(list_path, list_txt)
+            print(f"Subscription unchanged ({version}), skipping rewrite")
+            return sub_txt
+
+        # Withdraw the nodes of the previous subscription before it is replaced
+        delete_nodes()
 
-    sub_txt = base64.b64encode(list_txt.encode('utf-8')).decode('utf-8')
-    with open(os.path.join(FILE_PATH, 'sub.txt'), 'w', encoding='utf-8') as sub_file:
-        sub_file.write(sub_txt)
+        write_atomic(list_path, list_txt)
+        write_atomic(sub_path, sub_txt)
+        write_atomic(nodes_path, json.dumps(nodes, ensure_ascii=False))
+        write_atomic(links_state_path, json.dumps({"version": version, "inputs": inputs}))
+        sub_cache.invalidate()
+        status_board.update()
+        profiler.mark('first_subscription')
         
-    print(sub_txt)
+        print(sub_txt)
     
-    print(f"{FILE_PATH}/sub.txt saved successfully")
+        print(f"{FILE_PATH}/sub.txt saved successfully")
     
-    # Additional actions
+    # Additional actions, sent in the background by the outbound client
     send_telegram()
     upload_nodes()
   
@@ -506,21 +2386,14 @@ def add_visit_task():
         print("Skipping adding automatic access task")
         return
     
-    try:
-        response = requests.post(
-            'https://keep.gvrander.eu.org/add-url',
-            json={"url": PROJECT_URL},
-            headers={"Content-Type": "application/json"}
-        )
-        print('automatic access task added successfully')
-    except Exception as e:
-        print(f'Failed to add URL: {e}')
+    outbound.submit('POST', 'https://keep.gvrander.eu.org/add-url', 'add URL', json={"url": PROJECT_URL},
+                    on_response=lambda response: print('automatic access task added successfully'))
 
 # Clean up files after 90 seconds
 def clean_files():
     def _cleanup():
         time.sleep(90)  # Wait 90 seconds
-        files_to_delete = [boot_log_path, config_path, list_path, web_path, bot_path, php_path, npm_path]
+        files_to_delete = [*map(tunnel_log_path, tunnel_names()), config_path, list_path, web_path, bot_path, php_path, npm_path]
         
         if NEZHA_PORT:
             files_to_delete.append(npm_path)
@@ -543,35 +2416,307 @@ def clean_files():
     
     threading.Thread(target=_cleanup, daemon=True).start()
     
+# Deployment state pushed to local subscribers, children are sampled when a snapshot is built
+class StatusBoard:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.state = {"stage": "starting"}
+        self.version = 0
+
+    def update(self, **fields):
+        with self.condition:
+            self.state.update(fields)
+            self.version += 1
+            self.condition.notify_all()
+
+    # Block until the board changes or timeout passes, returns the version seen
+    def wait(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def snapshot(self):
+        with self.condition:
+            state = dict(self.state)
+        children = {
+            name: {"pid": status["pid"], "alive": status["alive"], "restarts": status["restarts"], "last_exit": status["last_exit"]}
+            for name, status in supervisor.status().items()
+        }
+        return {
+            **state,
+            "pid": os.getpid(),
+            "children": children,
+            "domains": current_domains(),
+            "subscription": {"ready": os.path.exists(sub_path), "version": current_links_version()},
+        }
+
+status_board = StatusBoard()
+
+# Newline-delimited JSON over a Unix socket: a snapshot on connect, then one per change.
+# Clients may send command lines such as "reload", results show up in the pushed state.
+class StatusServer:
+    HEARTBEAT = 2
+
+    def __init__(self, path, board):
+        self.path = path
+        self.board = board
+        self.sock = None
+        self.closed = threading.Event()
+        self.commands = {}
+
+    def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                print(f"Status socket {self.path} is served by another process")
+                return
+            except OSError:
+                os.remove(self.path)
+            finally:
+                probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(8)
+        threading.Thread(target=self.serve, name='status-server', daemon=True).start()
+
+    def serve(self):
+        while not self.closed.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.push, args=(conn,), daemon=True).start()
+            threading.Thread(target=self.listen, args=(conn,), daemon=True).start()
+
+    def listen(self, conn):
+        try:
+            for line in conn.makefile('r', encoding='utf-8', errors='replace'):
+                command = self.commands.get(line.strip())
+                if command:
+                    command()
+                elif line.strip():
+                    print(f"Unknown status socket command: {line.strip()}")
+        except (OSError, ValueError):
+            pass
+
+    # Child health changes without a board update, so re-sample on every heartbeat
+    def push(self, conn):
+        sent, version = None, None
+        with conn:
+            while not self.closed.is_set():
+                version = self.board.wait(version, self.HEARTBEAT)
+                payload = json.dumps(self.board.snapshot(), sort_keys=True)
+                if payload == sent:
+                    continue
+                try:
+                    conn.sendall(payload.encode('utf-8') + b'\n')
+                except OSError:
+                    return
+                sent = payload
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.closed.set()
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+status_server = StatusServer(STATUS_SOCKET, status_board)
+
+# Settings that can change without a restart, with how to parse them
+def parse_bool(value):
+    return value.lower() == 'true'
+
+# Parser and built-in default of every setting reload_config() can change; an empty value
+# in ENV_FILE restores the default
+RELOADABLE_SETTINGS = {
+    'UUID': (str, '9bc0b4b1-f952-480f-bb75-73651fe2b591'),
+    'NAME': (str, 'streamlit'),
+    'CFIP': (str, 'www.visa.com.tw'),
+    'CFPORT': (int, '443'),
+    'CFIP_LIST': (str, ''),
+    'CFPORT_LIST': (str, ''),
+    'CFIP_TOP': (int, '0'),
+    'XRAY_PROTOCOLS': (str, 'vless,vmess,trojan'),
+    'XRAY_SNIFFING': (parse_bool, 'true'),
+    'XRAY_SNIFF_DEST': (str, 'http,tls,quic'),
+    'XRAY_SNIFF_METADATA_ONLY': (parse_bool, 'false'),
+    'XRAY_BUFFER_SIZE': (int, '-1'),
+    'XRAY_LOGLEVEL': (str, 'none'),
+}
+
+# Parse `export KEY=value` lines as written by streamlit_app.py
+def read_env_file(path):
+    env = {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                tokens = shlex.split(line, comments=True)
+                if tokens and tokens[0] == 'export':
+                    tokens = tokens[1:]
+                for token in tokens:
+                    key, sep, value = token.partition('=')
+                    if sep:
+                        env[key] = value
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Error reading {path}: {e}")
+    return env
+
+reload_lock = asyncio.Lock()
+
+# Re-read the environment, rewrite config.json and the links, and restart only web when its config changed
+async def reload_config():
+    global WEB_PORTS
+    async with reload_lock:
+        os.environ.update(read_env_file(ENV_FILE))
+        # clean_files() may have removed config.json, so compare rendered configs rather than the file
+        xray_before = xray_config_json()
+
+        changed = []
+        for key, (parse, default) in RELOADABLE_SETTINGS.items():
+            if key not in os.environ:
+                continue
+            try:
+                value = parse(os.environ[key].strip() or default)
+            except ValueError as e:
+                print(f"Ignoring invalid {key} on reload: {e}")
+                continue
+            if value != globals()[key]:
+                globals()[key] = value
+                changed.append(key)
+
+        if not changed:
+            print("Reload: no settings changed")
+            status_board.update(reload={"at": time.time(), "changed": []})
+            return
+        print(f"Reload: {', '.join(changed)} changed")
+
+        if xray_config_json() != xray_before and supervisor.get('web'):
+            await asyncio.to_thread(write_xray_config)
+            WEB_PORTS = web_ports()
+            await asyncio.to_thread(supervisor.restart, 'web')
+            await wait_until_ready('web', [child_check('web'), port_check(WEB_PORTS)])
+
+        domains = current_domains()
+        if domains:
+            await generate_links(domains)
+            ensure_reprobe()
+        status_board.update(reload={"at": time.time(), "changed": changed})
+
+# Safe to call from signal handlers and socket threads
+def request_reload():
+    if main_loop is None:
+        print("Reload requested before startup finished, ignoring")
+        return
+    future = asyncio.run_coroutine_threadsafe(reload_config(), main_loop)
+    future.add_done_callback(lambda f: f.cancelled() or f.exception() and print(f"Reload failed: {f.exception()}"))
+
+status_server.commands['reload'] = request_reload
+
+def handle_reload(signum, frame):
+    print(f"Received signal {signum}, reloading configuration")
+    request_reload()
+
 # Main function to start the server
 async def start_server():
-    delete_nodes()
-    cleanup_old_files()
-    create_directory()
-    argo_type()
-    await download_files_and_run()
-    add_visit_task()
-    
+    global main_loop, previous_state
+    main_loop = asyncio.get_running_loop()
+    traced('cleanup_old_files', 'phase', cleanup_old_files)
+    traced('create_directory', 'phase', create_directory)
+    # Claim the recorded children right away, so a second app.py backs off
+    previous_state = load_state()
+    supervisor.adoptable = dict(previous_state.get("children", {}))
+    save_state()
+    if STATUS_SOCKET:
+        try:
+            status_server.start()
+        except OSError as e:
+            print(f"Status socket unavailable: {e}")
+
+    # Serve right away, the subscription route answers 404 until sub.txt exists
     server_thread = Thread(target=run_server)
     server_thread.daemon = True
-    server_thread.start()   
-    
+    server_thread.start()
+
+    start_isp_lookup()
+    traced('argo_type', 'phase', argo_type)
+    traced('add_visit_task', 'phase', add_visit_task)
+
+    with profiler.span('download_files_and_run', 'phase'):
+        started = await download_files_and_run()
+    if started:
+        supervisor.release_unclaimed()
+        # Extract domains and generate sub.txt
+        with profiler.span('extract_domains', 'phase'):
+            await extract_domains()
+
+    profiler.report(os.path.join(FILE_PATH, 'startup-profile.json'))
+    status_board.update(stage='running' if started else 'failed')
+    print(f"Running done！")
+    print(f"\nLogs will be delete in 90 seconds")
     clean_files()
     
+http_server = None
+shutdown_event = threading.Event()
+background_tasks = set()
+
 def run_server():
-    server = HTTPServer(('0.0.0.0', PORT), RequestHandler)
-    print(f"Server is running on port {PORT}")
-    print(f"Running done！")
-    print(f"\nLogs will be delete in 90 seconds")
-    server.serve_forever()
+    global http_server
+    http_server = SubscriptionServer(('0.0.0.0', PORT), RequestHandler)
+    print(f"Server is running on port {PORT}, up to {SERVER_MAX_CONNECTIONS} connections")
+    http_server.serve_forever()
+
+# Stop accepting new requests and let in-flight ones finish
+def stop_server():
+    if http_server is None:
+        return
+    http_server.shutdown()
+    http_server.server_close()
+    print('Server stopped')
+
+def handle_shutdown(signum, frame):
+    print(f"Received signal {signum}, shutting down")
+    shutdown_event.set()
+    
+# Keep the event loop running for background tasks until a shutdown signal arrives
+async def wait_for_shutdown():
+    while not shutdown_event.is_set():
+        await asyncio.sleep(1)
+    for task in background_tasks:
+        task.cancel()
     
 def run_async():
+    owner = live_owner(load_state())
+    if owner:
+        print(f"app.py (pid {owner}) is already running and owns the children in {state_path}, exiting")
+        return
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    signal.signal(signal.SIGHUP, handle_reload)
+
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(start_server()) 
-    
-    while True:
-        time.sleep(3600)
+    loop.run_until_complete(wait_for_shutdown())
+
+    status_board.update(stage='stopping')
+    stop_server()
+    outbound.flush()
+    if KEEP_CHILDREN:
+        supervisor.detach()
+    else:
+        supervisor.stop_all()
+    save_state()
+    status_server.close()
         
 if __name__ == "__main__":
     run_async()
@@ -1,89 +1,437 @@
+import io
 import os
+import re
+import sys
+import json
+import time
+import shlex
+import socket
+import hashlib
+import mimetypes
 import subprocess
 import streamlit as st
 import threading
-import asyncio
+from collections import deque
+from dataclasses import dataclass
+from PIL import Image
+
+# 媒体文件指纹（大小 + 修改时间），文件变化时缓存自动失效
+def media_fingerprint(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_size, info.st_mtime_ns)
+
+# 每个进程只读取一次媒体文件，所有会话共享同一份字节；
+# st.video 按内容哈希登记到 /media 接口，浏览器通过 Range 请求分段拉取
+@st.cache_resource(show_spinner=False)
+def load_media(path, fingerprint):
+    if fingerprint is None:
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    return {
+        "data": data,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "mime": mimetypes.guess_type(path)[0] or "application/octet-stream",
+    }
+
+POSTER_MAX_WIDTH = 1280
+
+def encode_jpeg(image, max_width, quality):
+    image = image.copy()
+    image.thumbnail((max_width, max_width * 4))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+# 预生成海报图和缩略图（缩略图用作页面图标）；原图不比海报宽时直接用原图，避免无意义的有损重编码
+@st.cache_resource(show_spinner=False)
+def load_image_variants(path, fingerprint):
+    media = load_media(path, fingerprint)
+    if not media:
+        return None
+    with Image.open(io.BytesIO(media["data"])) as image:
+        width = image.width
+        image = image.convert("RGB")
+        return {
+            "poster": encode_jpeg(image, POSTER_MAX_WIDTH, 82) if width > POSTER_MAX_WIDTH else media["data"],
+            "thumbnail": encode_jpeg(image, 128, 75),
+        }
+
+image_path = "./mv.jpg"
+image_variants = load_image_variants(image_path, media_fingerprint(image_path))
 
 # 设置页面
-st.set_page_config(page_title="Kelly-Troy", layout="wide")
+st.set_page_config(page_title="Kelly-Troy", page_icon=image_variants["thumbnail"] if image_variants else None, layout="wide")
+
+# 终端控制序列（颜色、清屏等），显示前去掉
+ANSI_ESCAPE = re.compile(r"\x1b(?:\[[0-?]*[ -/]*[@-~]|[@-Z\\-_]|c)")
+
+# 有上限的环形日志缓冲区，行数和总字符数都受限，超出时丢弃最旧的行
+class LogBuffer:
+    def __init__(self, max_lines=2000, max_chars=512 * 1024, max_line_length=2000):
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.max_line_length = max_line_length
+        self.lock = threading.Lock()
+        self.lines = deque()
+        self.size = 0
+
+    def append(self, line):
+        line = ANSI_ESCAPE.sub("", line).rstrip()
+        if len(line) > self.max_line_length:
+            line = line[:self.max_line_length] + " …"
+        with self.lock:
+            self.lines.append(line)
+            self.size += len(line)
+            while len(self.lines) > self.max_lines or self.size > self.max_chars:
+                self.size -= len(self.lines.popleft())
+
+    def clear(self):
+        with self.lock:
+            self.lines.clear()
+            self.size = 0
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.lines)
 
-# 全局日志变量（线程安全）
-log_buffer = []
+    def __len__(self):
+        with self.lock:
+            return len(self.lines)
 
-# UI 控制状态
-if "running" not in st.session_state:
-    st.session_state.running = False
-if "auto_started" not in st.session_state:
-    st.session_state.auto_started = False  # 控制是否已自动执行完
+# 全局日志变量（线程安全，进程内所有会话共享）
+@st.cache_resource
+def get_log_buffer():
+    return LogBuffer()
+
+log_buffer = get_log_buffer()
 
 st.title("🌐 Kelly-Troy")
 
 # 环境变量
-envs = {
-    "BOT_TOKEN": st.secrets.get("BOT_TOKEN", ""),
-    "CHAT_ID": st.secrets.get("CHAT_ID", ""),
-    "ARGO_AUTH": st.secrets.get("ARGO_AUTH", ""),
-    "ARGO_DOMAIN": st.secrets.get("ARGO_DOMAIN", ""),
-    "NEZHA_KEY": st.secrets.get("NEZHA_KEY", ""),
-    "NEZHA_PORT": st.secrets.get("NEZHA_PORT", ""),
-    "NEZHA_SERVER": st.secrets.get("NEZHA_SERVER", ""),
-}
-
-# 写出 .env 文件
-with open("./env.sh", "w") as shell_file:
-    shell_file.write("#!/bin/bash\n")
-    for k, v in envs.items():
-        os.environ[k] = v
-        shell_file.write(f"export {k}='{v}'\n")
+SECRET_KEYS = ("BOT_TOKEN", "CHAT_ID", "ARGO_AUTH", "ARGO_DOMAIN", "NEZHA_KEY", "NEZHA_PORT", "NEZHA_SERVER")
+# app.py 收到 reload 时会重新读取这些变量；全部写入 env.sh，空值表示恢复 app.py 的默认值
+RELOADABLE_KEYS = ("UUID", "NAME", "CFIP", "CFPORT", "CFIP_LIST", "CFPORT_LIST", "CFIP_TOP", "XRAY_PROTOCOLS",
+                   "XRAY_SNIFFING", "XRAY_SNIFF_DEST", "XRAY_SNIFF_METADATA_ONLY", "XRAY_BUFFER_SIZE", "XRAY_LOGLEVEL")
+ENV_SH = "./env.sh"
+STATUS_SOCKET = os.environ.get("STATUS_SOCKET", "/tmp/app-status.sock")
+
+# 部署配置：由 st.secrets 生成并校验，内容哈希决定是否需要重新写出
+@dataclass(frozen=True)
+class DeployConfig:
+    env: tuple
+    digest: str
+    problems: tuple
+
+    @classmethod
+    def from_secrets(cls, secrets):
+        env = tuple((key, str(secrets.get(key, "") or "").strip()) for key in SECRET_KEYS + RELOADABLE_KEYS)
+        values = dict(env)
+        problems = []
+        if values["NEZHA_PORT"] and not values["NEZHA_PORT"].isdigit():
+            problems.append("NEZHA_PORT 必须是数字")
+        if bool(values["NEZHA_SERVER"]) != bool(values["NEZHA_KEY"]):
+            problems.append("NEZHA_SERVER 和 NEZHA_KEY 需要同时设置")
+        if bool(values["BOT_TOKEN"]) != bool(values["CHAT_ID"]):
+            problems.append("BOT_TOKEN 和 CHAT_ID 需要同时设置")
+        if values["ARGO_DOMAIN"] and not values["ARGO_AUTH"]:
+            problems.append("设置了 ARGO_DOMAIN 但没有 ARGO_AUTH，将使用临时隧道")
+        digest = hashlib.sha256(json.dumps(env).encode("utf-8")).hexdigest()
+        return cls(env, digest, tuple(problems))
+
+def env_sh_digest():
+    try:
+        with open(ENV_SH) as f:
+            for line in f:
+                if line.startswith("# secrets-sha256: "):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return None
+
+# 通知正在运行的 app.py 重新读取 env.sh；没有在运行时忽略
+def request_backend_reload():
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(STATUS_SOCKET)
+            sock.sendall(b"reload\n")
+    except OSError:
+        pass
+
+# 记录本进程最后一次应用的 digest：secrets 变化（包括改回旧值）时写入 os.environ，
+# env.sh 内容不同才原子写出并通知 app.py 重新加载
+class ConfigMaterializer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digest = None
+
+    def apply(self, config):
+        with self.lock:
+            if config.digest == self.digest:
+                return
+            for key, value in config.env:
+                if key in RELOADABLE_KEYS and not value:
+                    # 空值不能进入环境变量，否则新启动的 app.py 会把它当作设置值
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            if env_sh_digest() != config.digest:
+                lines = ["#!/bin/bash", f"# secrets-sha256: {config.digest}"]
+                lines += [f"export {key}={shlex.quote(value)}" for key, value in config.env]
+                tmp_path = f"{ENV_SH}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as shell_file:
+                    shell_file.write("\n".join(lines) + "\n")
+                os.replace(tmp_path, ENV_SH)
+                request_backend_reload()
+            self.digest = config.digest
+
+@st.cache_resource(show_spinner=False)
+def get_config_materializer():
+    return ConfigMaterializer()
+
+config = DeployConfig.from_secrets(st.secrets)
+get_config_materializer().apply(config)
+for problem in config.problems:
+    st.warning(f"⚠️ 配置检查: {problem}")
+
+# 依赖安装缓存：requirements.txt 和解释器版本都没变时跳过安装
+DEPS_CACHE_DIR = os.path.expanduser("~/.cache/streamlit-deploy")
+WHEEL_DIR = os.path.join(DEPS_CACHE_DIR, "wheels")
+DEPS_STAMP = os.path.join(DEPS_CACHE_DIR, "requirements.sha256")
+
+def requirements_hash():
+    digest = hashlib.sha256()
+    with open("requirements.txt", "rb") as f:
+        digest.update(f.read())
+    digest.update(sys.version.encode("utf-8"))
+    return digest.hexdigest()
+
+def install_requirements():
+    started = time.monotonic()
+    digest = requirements_hash()
+    try:
+        with open(DEPS_STAMP) as f:
+            if f.read().strip() == digest:
+                log_buffer.append(f"📦 依赖未变化，跳过安装（{time.monotonic() - started:.2f}s）")
+                return
+    except OSError:
+        pass
+
+    # 已满足时 pip install 是空操作；缺的依赖优先从本地 wheel 缓存取
+    os.makedirs(WHEEL_DIR, exist_ok=True)
+    pip = [sys.executable, "-m", "pip"]
+    report_path = os.path.join(DEPS_CACHE_DIR, "install-report.json")
+    result = subprocess.run([*pip, "install", "-q", "-r", "requirements.txt", "--find-links", WHEEL_DIR, "--report", report_path])
+    if result.returncode != 0:
+        # 旧版 pip 不支持 --report，退回到普通安装
+        result = subprocess.run([*pip, "install", "-q", "-r", "requirements.txt", "--find-links", WHEEL_DIR])
+    if result.returncode != 0:
+        log_buffer.append(f"⚠️ 依赖安装失败（返回码 {result.returncode}），继续启动")
+        return
+    cache_fetched_wheels(pip, report_path)
+
+    with open(DEPS_STAMP + ".tmp", "w") as f:
+        f.write(digest)
+    os.replace(DEPS_STAMP + ".tmp", DEPS_STAMP)
+    log_buffer.append(f"📦 依赖安装完成，用时 {time.monotonic() - started:.1f}s")
+
+# 只把这次从索引下载的发行包放进 wheel 缓存；缓存失败不影响启动
+def cache_fetched_wheels(pip, report_path):
+    try:
+        with open(report_path) as f:
+            items = json.load(f).get("install", [])
+        wheel_dir_url = "file://" + os.path.abspath(WHEEL_DIR)
+        fetched = [
+            f"{item['metadata']['name']}=={item['metadata']['version']}" for item in items
+            if not item.get("download_info", {}).get("url", "").startswith(wheel_dir_url)
+        ]
+        if fetched:
+            subprocess.run([*pip, "wheel", "-q", "--no-deps", "-w", WHEEL_DIR, *fetched], check=True, timeout=600)
+    except (OSError, ValueError, KeyError, subprocess.SubprocessError) as e:
+        log_buffer.append(f"⚠️ 缓存 wheel 失败: {e}")
+
+# app.py 比本进程活得久：输出追加写入日志文件（而不是管道），本进程重启后 app.py 也不会因 EPIPE 出错
+APP_LOG = os.path.join(os.environ.get("FILE_PATH", "./.cache"), "app.log")
+APP_LOG_MAX_BYTES = 5 * 1024 * 1024
+
+# 按偏移量跟踪日志文件，新内容逐行转存到日志缓冲区；文件被截断或轮转后重新打开
+class LogTailer:
+    def __init__(self, path, buffer):
+        self.path = path
+        self.buffer = buffer
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        handle, inode = None, None
+        while True:
+            try:
+                stat = os.stat(self.path)
+                if handle is None or stat.st_ino != inode or stat.st_size < handle.tell():
+                    if handle:
+                        handle.close()
+                    handle, inode = open(self.path, "rb"), stat.st_ino
+                    # 打开（或重新打开）时最多回放最后 max_chars 字节
+                    start = max(0, stat.st_size - self.buffer.max_chars)
+                    handle.seek(start)
+                    if start:
+                        handle.readline()
+                for line in iter(handle.readline, b""):
+                    if not line.endswith(b"\n"):
+                        # 行还没写完，下次再读
+                        handle.seek(-len(line), os.SEEK_CUR)
+                        break
+                    self.buffer.append(line.decode("utf-8", errors="replace"))
+            except OSError:
+                pass
+            time.sleep(1)
+
+@st.cache_resource
+def get_log_tailer():
+    return LogTailer(APP_LOG, log_buffer)
+
+def wait_for_exit(process):
+    log_buffer.append(f"⚠️ app.py 已退出，返回码 {process.wait()}")
 
 # 后台部署函数
 def run_backend():
     try:
         log_buffer.append("📦 开始安装依赖和启动服务...")
-        subprocess.run("chmod +x app.py", shell=True, check=True)
-        subprocess.run("pip install -r requirements.txt", shell=True, check=True)
-        subprocess.Popen(["python", "app.py"])
+        os.chmod("app.py", 0o755)
+        install_requirements()
+        os.makedirs(os.path.dirname(APP_LOG), exist_ok=True)
+        if os.path.exists(APP_LOG) and os.path.getsize(APP_LOG) > APP_LOG_MAX_BYTES:
+            os.replace(APP_LOG, APP_LOG + ".1")
+        with open(APP_LOG, "ab") as log_file:
+            process = subprocess.Popen(
+                [sys.executable, "app.py"],
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                env={**os.environ, "PYTHONUNBUFFERED": "1"},
+                start_new_session=True,
+            )
+        threading.Thread(target=wait_for_exit, args=(process,), daemon=True).start()
         log_buffer.append("✅ 部署完成，服务已启动")
     except Exception as e:
         log_buffer.append(f"❌ 出错: {e}")
-    finally:
-        st.session_state.running = False
-        st.session_state.auto_started = True
-        with open("/tmp/deployed.flag", "w") as f:
-            f.write("done")
-
-# 定义异步任务
-async def main():
-    st.session_state.running = True
-    run_backend()
-
-# ✅ 自动部署逻辑（只执行一次）
-if not os.path.exists("/tmp/deployed.flag") and not st.session_state.running:
-    def auto_start():
-        asyncio.run(main())
-    threading.Thread(target=auto_start, daemon=True).start()
+
+# 部署任务状态（进程内所有会话共享，同一时间只允许一个部署任务）
+class Deployment:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = False
+        self.auto_started = False
+
+    def start(self, auto=False):
+        with self.lock:
+            if self.running or (auto and self.auto_started):
+                return False
+            self.running = True
+            self.auto_started = True
+        threading.Thread(target=self.run, daemon=True).start()
+        return True
+
+    def run(self):
+        try:
+            run_backend()
+        finally:
+            with self.lock:
+                self.running = False
+
+@st.cache_resource
+def get_deployment():
+    return Deployment()
+
+# 订阅 app.py 通过 Unix socket 推送的状态（每行一个 JSON），断开后自动重连
+class StatusSubscriber:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = None
+        self.checked = threading.Event()  # 至少尝试连接过一次
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.path)
+                    for line in sock.makefile("r", encoding="utf-8"):
+                        with self.lock:
+                            self.state = json.loads(line)
+                        self.checked.set()
+            except (OSError, ValueError):
+                pass
+            with self.lock:
+                self.state = None
+            self.checked.set()
+            time.sleep(1)
+
+    def latest(self):
+        with self.lock:
+            return self.state
+
+@st.cache_resource
+def get_status_subscriber():
+    return StatusSubscriber(STATUS_SOCKET)
+
+deployment = get_deployment()
+status_subscriber = get_status_subscriber()
+get_log_tailer()
+
+# ✅ 自动部署逻辑：app.py 没有在运行时，本进程只自动部署一次
+status_subscriber.checked.wait(2)
+if status_subscriber.latest() is None and deployment.start(auto=True):
     st.info("🚀 正在自动部署，请稍候...")
 
 # 手动按钮（也可触发）
 if st.button("🚀 启动部署"):
-    if not st.session_state.running:
+    if not deployment.running:
         log_buffer.clear()
-        threading.Thread(target=lambda: asyncio.run(main()), daemon=True).start()
+        deployment.start()
         st.success("✅ 已开始执行部署任务")
     else:
         st.warning("⚠️ 部署任务已在运行中")
 
-# 日志输出区域
-if log_buffer:
-    st.text_area("📄 部署日志输出", value="\n".join(log_buffer), height=300)
+# 运行状态，数据来自 app.py 的推送
+@st.fragment(run_every=2)
+def show_status():
+    state = status_subscriber.latest()
+    if state is None:
+        st.caption("⏳ 部署中，等待 app.py 启动..." if deployment.running else "⚪ app.py 未运行")
+        return
+    children = "  ".join(
+        f"{'🟢' if child['alive'] else '🔴'} {name}({child['pid']})" for name, child in state["children"].items()
+    )
+    subscription = state["subscription"]
+    st.caption(f"阶段: {state['stage']}  |  进程: {children or '无'}")
+    st.caption(
+        f"隧道域名: {', '.join(state['domains']) or '获取中'}  |  "
+        f"订阅: {subscription['version'] if subscription['ready'] else '未生成'}"
+    )
+
+show_status()
+
+# 日志输出区域，只有这一块定时刷新，不会重跑整个脚本
+@st.fragment(run_every=2)
+def show_logs():
+    lines = log_buffer.snapshot()
+    if lines:
+        st.text_area("📄 部署日志输出", value="\n".join(lines), height=300)
+
+show_logs()
 
 # 视频合集
 video_paths = ["./meinv.mp4", "./mv2.mp4"]
 for path in video_paths:
-    if os.path.exists(path):
-        st.video(path)
+    media = load_media(path, media_fingerprint(path))
+    if media:
+        st.video(media["data"], format=media["mime"])
 
-# 图片展示
-image_path = "./mv.jpg"
-if os.path.exists(image_path):
-    st.image(image_path, caption="南音", use_container_width=True)
+# 图片展示（过宽的原图会预先缩小）
+if image_variants:
+    st.image(image_variants["poster"], caption="南音", use_container_width=True)